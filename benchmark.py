@@ -0,0 +1,653 @@
+#!/usr/bin/python
+
+import os
+import sys
+import gc
+import copy
+import time
+import types
+import random
+import Queue
+import multiprocessing
+from collections import OrderedDict
+from comsim import *
+
+
+#
+#____________________________________________________________________________________
+#
+
+def makeHandshakeFlights():
+
+    # the DTLS handshake used in test_tls.py
+    return [
+        [
+            ProtocolMessage('ClientHello', 87)
+        ],
+        [
+            ProtocolMessage('ServerHello', 107),
+            ProtocolMessage('Certificate', 834),
+            ProtocolMessage('ServerKeyExchange', 165),
+            ProtocolMessage('CertificateRequest', 71),
+            ProtocolMessage('ServerHelloDone', 25)
+        ],
+        [
+            ProtocolMessage('Certificate', 834),
+            ProtocolMessage('ClientKeyExchange', 91),
+            ProtocolMessage('CertificateVerify', 97),
+            ProtocolMessage('ChangeCipherSpec', 13),
+            ProtocolMessage('Finished', 37)
+        ],
+        [
+            ProtocolMessage('ChangeCipherSpec', 13),
+            ProtocolMessage('Finished', 37)
+        ]
+    ]
+
+
+def runHandshake(scheduler, flights, lossRate=0.1, logger=None):
+
+    timeouts = lambda i: 2**i if i < 10 else None
+
+    server = GenericServerAgent('server1', scheduler, flights, timeouts=timeouts, logger=logger)
+    client = GenericClientAgent('client1', scheduler, flights, timeouts=timeouts, logger=logger)
+
+    medium = Medium(scheduler, data_rate=2400./8, msg_loss_rate=lossRate, inter_msg_time=0.001, logger=logger)
+    medium.registerAgent(client)
+    medium.registerAgent(server)
+    client.trigger()
+
+    scheduler.run()
+
+
+#
+#____________________________________________________________________________________
+#
+
+class LockedEventCalendar(object):
+    """
+    The event calendar used before the heap-based one: a thread-safe
+    Queue.PriorityQueue (kept here for comparison only)
+    """
+
+    def __init__(self):
+        self.queue = Queue.PriorityQueue()
+        self.seq = 0
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def push(self, time, priority, event):
+        self.seq += 1
+        self.queue.put((time, priority, self.seq, event))
+
+    def pop(self):
+        return self.queue.get()
+
+    def peek(self):
+        return self.queue.queue[0]
+
+    def compact(self, keep):
+        entries = []
+        while not self.queue.empty():
+            entries.append(self.queue.get())
+        for entry in entries:
+            if keep(entry[3]):
+                self.queue.put(entry)
+
+
+def benchmarkScheduler(replications=200):
+
+    print('Handshake throughput ({0} replications):'.format(replications))
+
+    flights = makeHandshakeFlights()
+
+    for name, backend in [('Queue.PriorityQueue', LockedEventCalendar),
+            ('heapq', HeapEventCalendar)]:
+
+        random.seed(0)
+        events = 0
+        start = time.time()
+        for i in range(replications):
+            scheduler = Scheduler(backend=backend)
+            runHandshake(scheduler, flights)
+            events += scheduler.getEventCount()
+        duration = time.time() - start
+
+        print('  {0:<24} {1:>8} events in {2:>.3f}s ({3:>.0f} events/s)' \
+                .format(name, events, duration, events / duration))
+
+
+def benchmarkCalendar(operations=100000):
+
+    # "hold" model: keep the number of pending events constant
+    # by re-inserting one new event for each dequeued event
+    print('Hold operations on event calendars (dequeue + enqueue):')
+
+    # random event times and synchronized periodic events (as of many
+    # BlockingAgents ticking at 500 Hz) with only 1000 distinct times
+    models = [
+        ('random', lambda rng, pending: rng.expovariate(1. / pending)),
+        ('periodic', lambda rng, pending: 0.002 * rng.randint(1, 1000)),
+    ]
+
+    for name, delay in models:
+        for pending in [10**3, 10**4, 10**5, 10**6]:
+
+            results = []
+            for backend in ['heap', 'calendar']:
+
+                rng = random.Random(0)
+                calendar = Scheduler.backends[backend]()
+                for i in range(pending):
+                    calendar.push(delay(rng, pending), rng.randint(0, 1), None)
+
+                start = time.time()
+                for i in range(operations):
+                    entry = calendar.pop()
+                    calendar.push(entry[0] + delay(rng, pending),
+                            rng.randint(0, 1), None)
+                results.append((time.time() - start) * 1e6 / operations)
+
+            print(('  {0:<8} N = {1:>7}: heap {2:>6.2f}us/op, ' +
+                    'calendar {3:>6.2f}us/op').format(name, pending, *results))
+
+
+def benchmarkBroadcast(messages=500):
+
+    print('Broadcast dispatch ({0} messages):'.format(messages))
+
+    for listeners in [10, 100, 1000]:
+
+        scheduler = Scheduler()
+        medium = Medium(scheduler, msg_loss_rate=0.1, seed=0)
+        sender = ProtocolAgent('sender', scheduler, medium=medium)
+        for i in range(listeners):
+            ProtocolAgent('listener{0}'.format(i), scheduler, medium=medium)
+        for i in range(messages):
+            sender.scheduleMsgTX(ProtocolMessage('M{0}'.format(i), 20))
+
+        start = time.time()
+        scheduler.run()
+        duration = time.time() - start
+
+        print(('  {0:>5} listeners: {1:>8.2f}us/message, ' +
+                '{2:>6.3f}us/reception').format(listeners,
+                        duration * 1e6 / messages,
+                        duration * 1e6 / (messages * listeners)))
+
+
+def benchmarkLossProp(rounds=20000):
+
+    # loss probabilities of all messages of the DTLS handshake flights
+    messages = [msg for flight in makeHandshakeFlights() for msg in flight]
+    print('Loss probabilities ({0} x {1} messages):'.format(
+            rounds, len(messages)))
+
+    medium = Medium(Scheduler(), msg_loss_rate=0.1, bit_loss_rate=1e-5)
+
+    for name, func in [
+            ('computed', lambda msg: medium.computeMsgLossProp(msg.getLength())),
+            ('cached', medium.getMsgLossProp)]:
+
+        start = time.time()
+        for i in range(rounds):
+            for msg in messages:
+                func(msg)
+        duration = time.time() - start
+
+        print('  {0:<10} {1:>6.3f}us/message'.format(
+                name, duration * 1e6 / (rounds * len(messages))))
+
+
+def benchmarkArbitration(messages=2000):
+
+    # one active sender among many idle agents: the cost per arbitration
+    # should not grow with the number of idle agents on the medium
+    print('Arbitration with idle agents ({0} messages):'.format(messages))
+
+    for idle in [10, 100, 1000]:
+
+        scheduler = Scheduler()
+        medium = Medium(scheduler)
+        for i in range(idle):
+            ProtocolAgent('idle{0}'.format(i), scheduler, medium=medium)
+        sender = ProtocolAgent('sender', scheduler, medium=medium)
+        ProtocolAgent('receiver', scheduler, medium=medium)
+        for i in range(messages):
+            sender.scheduleMsgTX(ProtocolMessage('M{0}'.format(i), 20),
+                    'receiver')
+
+        start = time.time()
+        scheduler.run()
+        duration = time.time() - start
+
+        print('  {0:>5} idle agents: {1:>7.2f}us/message'.format(
+                idle, duration * 1e6 / messages))
+
+
+def benchmarkNetwork(sizes=[10, 100, 1000]):
+
+    # handshakes between clients and servers on separate 2400 bit/s access
+    # media, connected by gateways through a shared fast backbone
+    print('Handshakes across a network (access - backbone - access):')
+
+    flights = makeHandshakeFlights()
+    timeouts = ExponentialTimeouts(1., 10)
+
+    for pairs in sizes:
+
+        scheduler = Scheduler()
+        backbone = Medium(scheduler, name='backbone', data_rate=1e6, seed=0)
+        network = Network(media=[backbone], header_length=8)
+        clients = []
+        for i in range(pairs):
+            for role in ['client', 'server']:
+                name = '{0}{1}'.format(role, i)
+                access = Medium(scheduler, name=name + '-access',
+                        data_rate=2400./8, msg_loss_rate=0.1,
+                        inter_msg_time=0.001, seed=0)
+                network.addMedium(access)
+                GatewayAgent(name + '-gateway', scheduler,
+                        media=[access, backbone])
+                if role == 'client':
+                    clients.append(GenericClientAgent(name, scheduler, flights,
+                            timeouts=timeouts, peer='server{0}'.format(i),
+                            medium=access))
+                else:
+                    GenericServerAgent(name, scheduler, flights,
+                            timeouts=timeouts, peer='client{0}'.format(i),
+                            medium=access)
+
+        start = time.time()
+        for client in clients:
+            client.trigger()
+        scheduler.run()
+        duration = time.time() - start
+
+        done = [client.doneAtTime for client in clients if client.done]
+        print(('  {0:>5} nodes: {1:>8} events in {2:>.3f}s ' +
+                '({3:>.0f} events/s), mean handshake time {4:>.3f}s').format(
+                        6 * pairs, scheduler.getEventCount(), duration,
+                        scheduler.getEventCount() / duration,
+                        sum(done) / max(len(done), 1)))
+
+
+def benchmarkEstimator(replications=1000):
+
+    # compare the analytical estimate with simulation results
+    print(('Analytical estimate vs. simulation ({0} replications, ' +
+            'mean / std / median / completion probability):').format(
+                    replications))
+
+    flights = makeHandshakeFlights()
+
+    # (only congestion-free timeouts are supported by the estimator)
+    for name, timeouts in [('linear 10s', LinearTimeouts(10., 10)),
+            ('exponential 10s', ExponentialTimeouts(10., 10))]:
+        for lossRate in [0.05, 0.1, 0.3, 0.5]:
+
+            scenario = HandshakeScenario(flights, timeouts, data_rate=2400./8,
+                    msg_loss_rate=lossRate, inter_msg_time=0.001)
+
+            start = time.time()
+            estimate = HandshakeEstimator(scenario).estimate()
+            estimateDuration = time.time() - start
+
+            start = time.time()
+            times = [result.completionTime for result in runReplications(
+                    scenario, replications, processes=1)
+                            if result.completionTime is not None]
+            simulationDuration = time.time() - start
+            simulated = Distribution(dict([(t, times.count(t) / float(replications))
+                    for t in set(times)]))
+
+            print('  {0} at loss rate {1:.2f}:'.format(name, lossRate))
+            for label, dist, duration in [('estimate', estimate, estimateDuration),
+                    ('simulation', simulated, simulationDuration)]:
+                print(('    {0:<10} {1:>8.3f}s {2:>8.3f}s {3:>8.3f}s {4:>7.2%} ' +
+                        '(in {5:>.3f}s)').format(label, dist.getMean(),
+                                dist.getStd(), dist.getMedian(), dist.getTotal(),
+                                duration))
+
+
+def benchmarkLockstep(replications=1000):
+
+    # the same replications with the event-driven and the lockstep engine
+    print(('Event-driven vs. lockstep replications ({0} replications, ' +
+            'mean / std / median / completion probability):').format(
+                    replications))
+
+    flights = makeHandshakeFlights()
+
+    for lossRate in [0.1, 0.3]:
+
+        scenario = HandshakeScenario(flights, ExponentialTimeouts(1., 10),
+                data_rate=2400./8, msg_loss_rate=lossRate, inter_msg_time=0.001)
+        print('  loss rate {0:.2f}:'.format(lossRate))
+
+        for name, run in [
+                ('event-driven', lambda: runReplications(
+                        scenario, replications, processes=1)),
+                ('lockstep', lambda: LockstepHandshakeSimulator(
+                        scenario).run(replications))]:
+
+            start = time.time()
+            results = run()
+            duration = time.time() - start
+
+            times = [result.completionTime for result in results
+                    if result.completionTime is not None]
+            dist = Distribution(dict([(t, times.count(t) / float(replications))
+                    for t in set(times)]))
+            print(('    {0:<12} {1:>8.3f}s {2:>8.3f}s {3:>8.3f}s {4:>7.2%} ' +
+                    '(in {5:>.3f}s, {6:>.0f} replications/s)').format(name,
+                            dist.getMean(), dist.getStd(), dist.getMedian(),
+                            dist.getTotal(), duration, replications / duration))
+
+
+def benchmarkAdaptive(precision=0.02):
+
+    # replications needed for the mean handshake time within +/- 2%
+    print('Adaptive replications (mean within +/-{0:.0%} at 95% confidence):' \
+            .format(precision))
+
+    flights = makeHandshakeFlights()
+
+    for lossRate in [0.01, 0.05, 0.1, 0.3]:
+
+        scenario = HandshakeScenario(flights, LinearTimeouts(10., 10),
+                data_rate=2400./8, msg_loss_rate=lossRate, inter_msg_time=0.001)
+
+        start = time.time()
+        result = runAdaptiveReplications(scenario,
+                relative_precision=precision, max_replications=20000)
+        duration = time.time() - start
+
+        print(('  loss rate {0:.2f}: {1:>8.3f}s +/- {2:>6.3f}s after {3:>5} ' +
+                'replications{4} (in {5:>.3f}s)').format(lossRate,
+                        result.estimate, result.halfWidth, result.replications,
+                        '' if result.converged else ' (not converged)', duration))
+
+
+def makeCheckpointSimulation(pairs, lossRate=0.1):
+
+    # <pairs> handshakes sharing one medium with a blocking agent
+    flights = makeHandshakeFlights()
+    scheduler = Scheduler()
+    medium = Medium(scheduler, data_rate=2400./8, msg_loss_rate=lossRate,
+            inter_msg_time=0.001, seed=0)
+    blocker = BlockingAgent('blocker', scheduler, 5., 0.01)
+    medium.registerAgent(blocker, 0)
+    blocker.start()
+    clients = []
+    for i in range(pairs):
+        client = GenericClientAgent('client{0}'.format(i), scheduler,
+                flights, timeouts=LinearTimeouts(10., 10))
+        server = GenericServerAgent('server{0}'.format(i), scheduler,
+                flights, timeouts=LinearTimeouts(10., 10))
+        medium.registerAgent(client)
+        medium.registerAgent(server)
+        client.trigger()
+        clients.append(client)
+    return scheduler, medium, clients
+
+
+def benchmarkCheckpoint(pairs=20, prefix=60., path='/tmp/comsim-benchmark.pickle'):
+
+    # the cost of re-simulating a prefix vs. resuming from a snapshot of it
+    print('Checkpoint of {0} handshakes after {1:.0f}s of simulated time:' \
+            .format(pairs, prefix))
+
+    start = time.time()
+    simulation = makeCheckpointSimulation(pairs)
+    scheduler = simulation[0]
+    while scheduler.getTime() < prefix:
+        scheduler.runStep()
+    duration = time.time() - start
+    print('  {0:<24} {1:>8.3f}s ({2} events)'.format('simulate prefix',
+            duration, scheduler.getEventCount()))
+
+    start = time.time()
+    saveCheckpoint(path, simulation)
+    duration = time.time() - start
+    print('  {0:<24} {1:>8.3f}s ({2:>.0f} kB)'.format('save snapshot',
+            duration, os.path.getsize(path) / 1024.))
+
+    start = time.time()
+    resumed = loadCheckpoint(path)
+    duration = time.time() - start
+    print('  {0:<24} {1:>8.3f}s'.format('load snapshot', duration))
+
+    # continuing the original and the resumed simulation (the blocking
+    # agent never stops) gives the same result
+    for scheduler in [simulation[0], resumed[0]]:
+        while scheduler.getTime() < 4 * prefix:
+            scheduler.runStep()
+    same = [getattr(c, 'doneAtTime', None) for c in simulation[2]] == \
+            [getattr(c, 'doneAtTime', None) for c in resumed[2]]
+    print('  {0:<24} {1}'.format('identical continuation', same))
+    os.remove(path)
+
+
+def continueSimulation(simulation, duration=60.):
+
+    # run a simulation built by makeCheckpointSimulation() a bit further
+    scheduler, medium, clients = simulation
+    end = scheduler.getTime() + duration
+    while scheduler.getTime() < end:
+        scheduler.runStep()
+    return len([c for c in clients if hasattr(c, 'doneAtTime')])
+
+
+def benchmarkFork(branches=50, pairs=20, prefix=600.):
+
+    # continuations of a shared prefix: re-simulated vs. forked from a snapshot
+    print(('{0} continuations of {1} handshakes after a prefix of {2:.0f}s ' +
+            'of simulated time:').format(branches, pairs, prefix))
+
+    def simulatePrefix():
+        simulation = makeCheckpointSimulation(pairs)
+        scheduler = simulation[0]
+        while scheduler.getTime() < prefix:
+            scheduler.runStep()
+        return simulation
+
+    start = time.time()
+    results = []
+    for i in range(branches):
+        simulation = simulatePrefix()
+        simulation[1].reseed(deriveSeed(0, i))
+        results.append(continueSimulation(simulation))
+    duration = time.time() - start
+    print('  {0:<24} {1:>8.3f}s'.format('re-simulated prefix', duration))
+
+    for processes in [1, None]:
+        start = time.time()
+        simulation = simulatePrefix()
+        forked = forkSimulation(simulation, [simulation[1]],
+                continueSimulation, branches, processes=processes)
+        duration = time.time() - start
+        print('  {0:<24} {1:>8.3f}s (identical results: {2})'.format(
+                'forked ({0} processes)'.format(processes or
+                        multiprocessing.cpu_count()), duration,
+                forked == results))
+
+
+def benchmarkProfile(replications=200):
+
+    # the cost of profiling and where the time of a handshake run goes
+    print('Profiling ({0} replications):'.format(replications))
+
+    flights = makeHandshakeFlights()
+
+    for name, makeProfiler in [('disabled', lambda: None),
+            ('enabled', EventProfiler)]:
+
+        random.seed(0)
+        profiler = makeProfiler()
+        events = 0
+        start = time.time()
+        for i in range(replications):
+            scheduler = Scheduler(profiler=profiler)
+            runHandshake(scheduler, flights)
+            events += scheduler.getEventCount()
+        duration = time.time() - start
+
+        print('  {0:<24} {1:>8} events in {2:>.3f}s ({3:>.0f} events/s)' \
+                .format(name, events, duration, events / duration))
+
+    print(TextFormatter.indent(profiler.report()))
+
+
+class NullLogger(object):
+    """
+    A logger accepting messages of <level> and above and discarding them
+    """
+
+    def __init__(self, level=LogLevel.DEBUG):
+        self.level = level
+
+    def log(self, header, text):
+        pass
+
+
+def benchmarkLogging(replications=200):
+
+    print('Handshake throughput with logging ({0} replications):'.format(
+            replications))
+
+    flights = makeHandshakeFlights()
+
+    for name, logger in [('off', None), ('warnings only', NullLogger(LogLevel.WARNING)),
+            ('on (discarded)', NullLogger())]:
+
+        random.seed(0)
+        events = 0
+        start = time.time()
+        for i in range(replications):
+            scheduler = Scheduler()
+            runHandshake(scheduler, flights, logger=logger)
+            events += scheduler.getEventCount()
+        duration = time.time() - start
+
+        print('  {0:<16} {1:>8} events in {2:>.3f}s ({3:>.0f} events/s)' \
+                .format(name, events, duration, events / duration))
+
+
+def deepSizeOf(obj, shared):
+    """
+    Return the number of bytes of <obj> and all objects reachable from it
+    except for the objects in <shared>, classes, functions and modules
+    """
+
+    skip = set([id(o) for o in shared])
+    stack = [obj]
+    size = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in skip or isinstance(o, (type, types.ClassType,
+                types.FunctionType, types.BuiltinFunctionType, types.ModuleType)):
+            continue
+        skip.add(id(o))
+        size += sys.getsizeof(o)
+        stack.extend(gc.get_referents(o))
+
+    return size
+
+
+class DictCallback(Event):
+    """
+    A callback event storing its arguments in a dictionary (the
+    way Callback did before; kept here for comparison only)
+    """
+
+    def __init__(self, callback, **pars):
+        self.callback = callback
+        self.pars = pars
+
+    def execute(self):
+        self.callback(**self.pars)
+
+
+class DictProtocolMessage(object):
+    """
+    A protocol message with a __dict__ (the way ProtocolMessage was
+    before; kept here for comparison only)
+    """
+
+    def __init__(self, message, length):
+        self.name = message
+        self.length = length
+
+
+def benchmarkMemory(events=10000):
+
+    print('Memory footprint:')
+
+    scheduler = Scheduler()
+    medium = Medium(scheduler)
+    sender = ProtocolAgent('sender', scheduler, medium=medium)
+    receiver = ProtocolAgent('receiver', scheduler, medium=medium)
+    message = ProtocolMessage('Certificate', 834)
+    shared = [scheduler, medium, sender, receiver, message]
+
+    # a pending event: the reception of a message by an agent
+    for name, makeEvent in [
+            ('dict-based callback', lambda: DictCallback(
+                    receiver.receive, message=message, sender=sender)),
+            ('slotted callback', lambda: Callback(
+                    receiver.receive, message, sender))]:
+        scheduler.reset()
+        for i in range(events):
+            scheduler.registerEventRel(makeEvent(), float(i))
+        print('  {0:<24} {1:>6.1f} bytes per pending event'.format(name,
+                float(deepSizeOf(scheduler.queue, shared)) / events))
+
+    # an in-flight message: one transmission of a flight's message
+    template = DictProtocolMessage('Certificate', 834)
+    for name, size in [
+            ('deep copy of message', deepSizeOf(copy.deepcopy(template), [])),
+            ('transmission envelope', deepSizeOf(message.transmission(1), shared))]:
+        print('  {0:<24} {1:>6.1f} bytes per in-flight message'.format(
+                name, float(size)))
+
+
+#
+#____________________________________________________________________________________
+#
+
+benchmarks = OrderedDict([
+    ('scheduler', benchmarkScheduler),
+    ('calendar', benchmarkCalendar),
+    ('broadcast', benchmarkBroadcast),
+    ('lossprop', benchmarkLossProp),
+    ('arbitration', benchmarkArbitration),
+    ('network', benchmarkNetwork),
+    ('estimator', benchmarkEstimator),
+    ('lockstep', benchmarkLockstep),
+    ('adaptive', benchmarkAdaptive),
+    ('checkpoint', benchmarkCheckpoint),
+    ('fork', benchmarkFork),
+    ('profile', benchmarkProfile),
+    ('logging', benchmarkLogging),
+    ('memory', benchmarkMemory),
+])
+
+
+def main(argv):
+
+    names = argv if argv else benchmarks.keys()
+    for name in names:
+        if name not in benchmarks:
+            print('Unknown benchmark "{0}" (choose from {1})'.format(
+                    name, ', '.join(benchmarks.keys())))
+            return
+        benchmarks[name]()
+
+
+#
+# _____________________________________________________________________________
+#
+if __name__ == "__main__":
+    main(sys.argv[1:]);
@@ -1,10 +1,26 @@
+import os
 import sys
+import copy
+import time
 import random
-import Queue
+import heapq
+import bisect
 import collections
 import math
-import copy
 import itertools
+import multiprocessing
+import hashlib
+import struct
+import json
+import types
+import copy_reg
+import cPickle
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is only needed for optional features
+    numpy = None
 
 
 class TextFormatter(object):
@@ -79,328 +95,1389 @@ class TextFormatter(object):
         return '\n'.join(lines)
 
 
-class Event(object):
+class LogLevel(object):
     """
-    This is the base class for scheduler events
+    The levels of log messages. A logger can define an attribute 'level'
+    to suppress messages below that level (loggers without it get all).
     """
 
-    def execute(self):
-        pass    
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
 
 
-class Callback(Event):
+class Loggable(object):
     """
-    This is the class representing a callback event for the scheduler
+    This is the base class of components writing to a logger (attribute
+    'logger', None means no logging). Log messages are only formatted if
+    there is a logger accepting them: log(text, *args) formats <text>
+    using <args>, and <text> may also be a callable returning the text.
+    Keyword arguments are 'level' (default: LogLevel.INFO) and 'style'
+    (a TextFormatter function applied to the formatted text).
     """
 
-    def __init__(self, callback, **pars):
-        self.callback = callback
-        self.pars = pars
+    def isLogging(self, level=LogLevel.INFO):
+        return self.logger is not None and \
+                level >= getattr(self.logger, 'level', LogLevel.DEBUG)
 
-    def execute(self):
-        self.callback(**self.pars)
+    def log(self, text, *args, **kwargs):
+        logger = self.logger
+        if logger is None:
+            return
+        if kwargs.get('level', LogLevel.INFO) < \
+                getattr(logger, 'level', LogLevel.DEBUG):
+            return
 
+        if args:
+            text = text.format(*args)
+        elif callable(text):
+            text = text()
+        style = kwargs.get('style', None)
+        if style is not None:
+            text = style(text)
 
-class Scheduler(object):
+        header = '[{0:>.3f}s]'.format(self.scheduler.getTime())
+        logger.log(header, '{0}: {1}'.format(self.getName(), text))
 
-    def __init__(self):
-        self.reset()
 
-    def reset(self):
-        self.time = 0.
-        self.queue = Queue.PriorityQueue()
+def deriveSeed(seed, *keys):
+    """
+    Derive the seed of an independent random substream from a master <seed>
+    and a path of <keys> (e.g. the index of a replication and the name of a
+    component). Derived seeds are obtained by hashing (SHA-256) and are
+    therefore uncorrelated even for neighbouring keys:
 
-    def registerEventAbs(self, event, time, priority=0):
-        if time < self.time:
-            raise Exception('Cannot register event in past')
-        self.queue.put((time, priority, event))
-        return time
+        deriveSeed(42, 7)              # replication #7 of a run with seed 42
+        deriveSeed(42, 7, 'Medium')    # the medium within replication #7
+    """
+    path = '/'.join([str(key) for key in (seed,) + keys])
+    return int(hashlib.sha256(path.encode('utf-8')).hexdigest()[:16], 16)
 
-    def registerEventRel(self, event, time, priority=0):
-        return self.registerEventAbs(event, self.time + time, priority)
 
-    def getTime(self):
-        return self.time
+def makeRandomStream(seed=None, *keys):
+    """
+    Return a new random stream (random.Random) seeded with the seed derived
+    from <seed> and <keys> (see deriveSeed). If <seed> is None the stream
+    is seeded from the module-global random generator such that calling
+    random.seed() still makes a simulation reproducible.
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    return random.Random(deriveSeed(seed, *keys))
 
-    def done(self):
-        return self.queue.empty()
 
-    def runStep(self):
+class TraceRecorder(object):
+    """
+    This class records simulation events as fixed-width binary records
+    (time, kind, lost, agent, message, length) into a preallocated buffer
+    that is written to <path> whenever it is full. Agents and messages are
+    recorded as integer ids; the corresponding names are written to
+    <path>.json on close(). Use readTrace() to load a trace.
+    """
+
+    # the kinds of records
+    EVENT = 0       # the scheduler executed an event
+    ENQUEUE = 1     # an agent queued a message for transmission
+    TX = 2          # the medium started to transmit a message
+    RX = 3          # an agent received a message
+    LOSS = 4        # a message got lost on its way to an agent
+
+    kinds = ['EVENT', 'ENQUEUE', 'TX', 'RX', 'LOSS']
+
+    # the record layout: (name, struct format, NumPy type)
+    fields = [
+        ('time', 'd', '<f8'),
+        ('kind', 'B', 'u1'),
+        ('lost', 'B', 'u1'),
+        ('agent', 'i', '<i4'),
+        ('message', 'i', '<i4'),
+        ('length', 'I', '<u4'),
+    ]
+
+    record = struct.Struct('<' + ''.join([f[1] for f in fields]))
+
+    # the file header: magic, format version and record size
+    header = struct.Struct('<4sHH')
+    magic = b'CSTR'
+    version = 1
+
+    def __init__(self, path, capacity=65536):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(TraceRecorder.header.pack(TraceRecorder.magic,
+                TraceRecorder.version, TraceRecorder.record.size))
+        self.buffer = bytearray(TraceRecorder.record.size * capacity)
+        self.offset = 0
+        self.count = 0
+        self.agentIds = {}
+        self.messageIds = {}
+
+    def getId(self, ids, name):
+        try:
+            return ids[name]
+        except KeyError:
+            ids[name] = len(ids)
+            return ids[name]
+
+    def recordEvent(self, kind, time, agent=None, message=None, lost=False):
         """
-        Run one single step
+        Record an event of <kind> involving an agent (name) and a message
         """
 
-        if self.queue.empty():
-            # there is no event to process => just do nothing
-            return self.time
+        if agent is None:
+            agentId = -1
+        else:
+            agentId = self.getId(self.agentIds, agent)
 
-        # retrieve the next event from the queue
-        time, priority, event = self.queue.get()
-        if time < self.time:
-            raise Exception('Cannot handle event from past')
+        if message is None:
+            messageId = -1
+            length = 0
+        else:
+            messageId = self.getId(self.messageIds, message.getName())
+            length = message.getLength() \
+                    if isinstance(message, ProtocolMessage) else 0
+
+        TraceRecorder.record.pack_into(self.buffer, self.offset,
+                time, kind, lost, agentId, messageId, length)
+        self.offset += TraceRecorder.record.size
+        self.count += 1
+        if self.offset == len(self.buffer):
+            self.flush()
+
+    def getCount(self):
+        return self.count
+
+    def flush(self):
+        self.file.write(self.buffer[:self.offset])
+        self.offset = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
 
-        # proceed current time to event time
-        self.time = time
+        # write the names belonging to the ids
+        names = {'kinds': TraceRecorder.kinds}
+        for key, ids in [('agents', self.agentIds),
+                ('messages', self.messageIds)]:
+            names[key] = sorted(ids, key=lambda name: ids[name])
+        with open(self.path + '.json', 'w') as f:
+            json.dump(names, f)
 
-        # execute the event
-        event.execute()
+    def __getstate__(self):
+        raise Exception('Cannot checkpoint a simulation that is being traced')
 
-        # return the new current time
-        return self.time
+    def __enter__(self):
+        return self
 
-    def run(self):
-        while not self.done():
-            self.runStep()
+    def __exit__(self, *exc):
+        self.close()
 
 
-class Message(object):
+def readTrace(path):
+    """
+    Load a trace written by a TraceRecorder. Returns (records, names) where
+    <records> is a NumPy structured array with one entry per record and
+    <names> is a dictionary mapping 'kinds', 'agents' and 'messages' to the
+    lists of names indexed by the ids used in the records.
+    """
 
-    def __init__(self, name):
-        self.name = name
+    if numpy is None:
+        raise Exception('Reading traces requires NumPy')
 
-    def __str__(self):
-        return '[{0}]'.format(self.name)
+    dtype = numpy.dtype([(f[0], f[2]) for f in TraceRecorder.fields])
 
-    def getName(self):
-        return self.name
+    with open(path, 'rb') as f:
+        magic, version, size = TraceRecorder.header.unpack(
+                f.read(TraceRecorder.header.size))
+        if magic != TraceRecorder.magic or size != dtype.itemsize:
+            raise Exception('"{0}" is not a valid trace file'.format(path))
+        records = numpy.fromfile(f, dtype=dtype)
 
+    with open(path + '.json') as f:
+        names = json.load(f)
 
-class ProtocolMessage(Message):
+    return records, names
 
-    def __init__(self, message, length):
-        Message.__init__(self, message)
-        self.length = length
 
-    def __str__(self):
-        return '<{0}>(L={1})'.format(self.getName(), self.length)
+class EventProfiler(object):
+    """
+    This class accounts the number of executed events and the wall-clock
+    time spent executing them, grouped by the target of the event (e.g.
+    'Medium.doMsgTX' for callbacks of bound methods, the name of the
+    function for other callbacks and the class name for other events) and
+    by the agent or medium the target belongs to. The time of an event
+    includes everything it calls (e.g. a medium arbitrating on unblock),
+    except for calls made through call() (e.g. the receptions of a
+    broadcast delivered by one event), which are accounted to their own
+    target and agent. Pass it to the scheduler as 'profiler' to enable
+    profiling.
+    """
 
-    def getLength(self):
-        return self.length
+    # the clock used to measure execution times
+    clock = staticmethod(time.time)
 
-    def fragment(self, lenPayload, lenFixed):
-        
-        fragments = []
+    def __init__(self):
+        self.reset()
 
-        msgLen = self.getLength()
-        while msgLen > 0:
-            lenFrag = min(msgLen, lenPayload)
-            msgLen -= lenFrag
-            fragments.append(ProtocolMessage('{0}.f{1}'.format(
-                    self.getName(), len(fragments)), lenFrag + lenFixed))
+    def reset(self):
+        # [count, time] by target and by agent name
+        self.targets = {}
+        self.agents = {}
+        self.count = 0
+        self.time = 0.
+        # the time of calls made through call() within the current event
+        self.nested = 0.
 
-        return fragments
+    def getTarget(self, event):
+        """
+        Return (target, agent name) of <event> (agent name None if the
+        target does not belong to an agent or medium)
+        """
+        callback = getattr(event, 'callback', None)
+        if callback is None:
+            return type(event).__name__, None
+        return self.getCallbackTarget(callback)
+
+    def getCallbackTarget(self, callback):
+        owner = getattr(callback, 'im_self', None)
+        if owner is None:
+            return getattr(callback, '__name__', type(callback).__name__), None
+        target = '{0}.{1}'.format(type(owner).__name__, callback.__name__)
+        if isinstance(owner, (Agent, Medium)):
+            return target, owner.getName()
+        return target, None
+
+    def account(self, target, agent, duration):
+        for stats, key in [(self.targets, target), (self.agents, agent)]:
+            entry = stats.get(key)
+            if entry is None:
+                stats[key] = [1, duration]
+            else:
+                entry[0] += 1
+                entry[1] += duration
 
+    def record(self, event, duration):
+        target, agent = self.getTarget(event)
+        self.count += 1
+        self.time += duration
+        self.account(target, agent, duration - self.nested)
+        self.nested = 0.
 
-class Agent(object):
+    def call(self, callback, *args):
+        """
+        Call <callback> within the current event and account the time
+        spent to the callback's target and agent instead of the event's
+        """
+        start = self.clock()
+        callback(*args)
+        duration = self.clock() - start
+        self.nested += duration
+        target, agent = self.getCallbackTarget(callback)
+        self.account(target, agent, duration)
 
-    def __init__(self, name, scheduler, **params):
-        self.name = name
-        self.scheduler = scheduler
-        self.logger = params.get('logger', None)
-        self.medium = None
+    def getCount(self):
+        return self.count
 
-        medium = params.get('medium', None)
-        if medium:
-            medium.registerAgent(self)
+    def getTime(self):
+        return self.time
 
-    def getName(self):
-        return self.name
+    def getTargetStats(self):
+        """
+        Return a list of (target, count, time) sorted by decreasing time
+        """
+        return sorted([(key, n, t) for key, (n, t) in self.targets.items()],
+                key=lambda entry: -entry[2])
 
-    def registerMedium(self, medium):
-        if self.medium:
-            raise Exception('Agent "{0}" already registered with medium'.format(self.name))
-        self.medium = medium
+    def getAgentStats(self):
+        """
+        Return a list of (agent name, count, time) sorted by decreasing time
+        (events not belonging to an agent or medium are listed as None)
+        """
+        return sorted([(key, n, t) for key, (n, t) in self.agents.items()],
+                key=lambda entry: -entry[2])
 
-    def offerMedium(self, medium):
-        return False
+    def report(self, limit=None):
+        """
+        Return a text table of the <limit> most expensive targets and agents
+        """
+        lines = ['{0} events in {1:.3f}s'.format(self.count, self.time)]
+        for title, stats in [('target', self.getTargetStats()),
+                ('agent', self.getAgentStats())]:
+            lines.append('{0:<40} {1:>10} {2:>10} {3:>7} {4:>9}'.format(
+                    title, 'events', 'time', 'share', 'per event'))
+            for key, n, t in stats[:limit]:
+                lines.append('{0:<40} {1:>10} {2:>9.3f}s {3:>7.1%} {4:>7.2f}us'
+                        .format('-' if key is None else key, n, t,
+                                t / self.time if self.time else 0.,
+                                1e6 * t / n))
+        return '\n'.join(lines)
 
-    def receive(self, message, sender):
-        pass
+    def export(self, path):
+        """
+        Write the statistics to <path> (JSON)
+        """
+        data = {
+            'count': self.count,
+            'time': self.time,
+            'targets': [list(entry) for entry in self.getTargetStats()],
+            'agents': [list(entry) for entry in self.getAgentStats()],
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f)
 
-    def log(self, text):
-        if self.logger:        
-            header = '[{0:>.3f}s]'.format(self.scheduler.getTime())
-            self.logger.log(header, '{0}: {1}'.format(self.getName(), text))
 
+class Event(object):
+    """
+    This is the base class for scheduler events
+    """
 
-class BlockingAgent(Agent):
+    __slots__ = ()
 
-    def __init__(self, name, scheduler, frequency, duration, **params):
-        Agent.__init__(self, name, scheduler, **params)
-        self.running = False
-        self.queue = 0
-        self.withhold = False
+    def execute(self):
+        pass    
 
-        # Whether blocking request shall be piled up
-        self.queuing = params.get('queuing', False)
 
-        # The frequency of blocking requests in requests per second
-        self.frequency = frequency
+class Callback(Event):
+    """
+    This is the class representing a callback event for the scheduler. The
+    callback is called with the given positional and keyword arguments.
+    """
 
-        # The duration of each blocking request in seconds
-        self.duration = duration
+    __slots__ = ('callback', 'args', 'pars')
 
-        # The minimum separation time between blocking request in seconds
-        self.min_sep_time = params.get('min_sep_time', 0)
+    def __init__(self, callback, *args, **pars):
+        self.callback = callback
+        self.args = args
+        # don't keep an empty dictionary for each event
+        self.pars = pars or None
 
-        if (1. / self.frequency) <= (float(self.duration) + self.min_sep_time):
-            raise Exception('Blocking frequency higher than' + 
-                    ' duration and minimum separation time allows')
+    def execute(self):
+        if self.pars is None:
+            self.callback(*self.args)
+        else:
+            self.callback(*self.args, **self.pars)
 
-    def start(self):
-        self.queue = 0
-        self.running = True
-        self.tick()
 
-    def stop(self):
-        self.queue = 0
-        self.running = False
+class EventHandle(object):
+    """
+    This is the handle returned by the scheduler for each registered event.
+    It can be used to cancel the event as long as it is pending.
+    """
 
-    def tick(self):
+    __slots__ = ('scheduler', 'event', 'time')
 
-        if not self.running:
-            return
+    def __init__(self, scheduler, event, time):
+        self.scheduler = scheduler
+        # the event (None once it has been executed or cancelled)
+        self.event = event
+        self.time = time
 
-        if self.queuing:
-            # Pile-up blocking requests
-            self.queue += 1
-        else:
-            # Request blocking
-            self.queue = 1
+    def getTime(self):
+        return self.time
 
-        # Trigger arbitration of medium to ensure medium access
-        self.medium.arbitrate()
+    def isPending(self):
+        return self.event is not None
 
-        # register next blocking request
-        nextTick = self.scheduler.registerEventRel(
-                Callback(self.tick), 1. / self.frequency)
+    def cancel(self):
+        """
+        Cancel the event. The event stays in the scheduler's event calendar
+        as a tombstone and is dropped once it is due (or on compaction).
+        """
+        if self.event is not None:
+            self.event = None
+            self.scheduler.cancelEvent(self)
 
-    def offerMedium(self, medium):
 
-        if not self.withhold and self.queue > 0:        
+class EventCalendar(object):
+    """
+    This is the base class of event calendars numbering their entries by
+    a sequence counter (attribute 'counter'). Counters cannot be pickled:
+    pickled calendars continue with a fresh counter starting with the next
+    sequence number.
+    """
 
-            # Block the medium
-            self.queue -= 1
-            medium.blockMedium(self, self.duration)
+    def __getstate__(self):
+        seq = next(self.counter)
+        self.counter = itertools.count(seq)
+        state = self.__dict__.copy()
+        state['counter'] = seq
+        return state
 
-            if self.queue > 0:
-                queueStr = ' ({0} blocking requests left)'.format(self.queue)
-            else:
-                queueStr = ''
-            self.log('Blocking medium for {0:f}s{1}'.format(
-                    self.duration, queueStr))
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.counter = itertools.count(state['counter'])
 
-            # Ensure minimum separation time
-            if self.min_sep_time:
-                self.withhold = True
-                def unWithhold(agent, medium):
-                    agent.withhold = False
-                    medium.arbitrate()
-                self.scheduler.registerEventRel(Callback(
-                        unWithhold, agent=self, medium=medium),
-                        float(self.duration) + self.min_sep_time)
 
-            return True
-        else:
-            return False
+class HeapEventCalendar(EventCalendar):
+    """
+    This is the default event calendar of the scheduler. It keeps pending
+    events in a binary heap (heapq) without any locking. Each entry is a
+    tuple (time, priority, seq, event) where seq is a monotonically increasing
+    sequence number: events with equal time and priority are returned in the
+    order of their insertion and Event objects are never compared.
+    """
 
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
 
-class ProtocolAgent(Agent):
+    def __len__(self):
+        return len(self.heap)
 
-    def __init__(self, name, scheduler, **params):
-        Agent.__init__(self, name, scheduler, **params)
-        self.txQueue = collections.deque()
-        self.txCount = 0
-        self.rxCount = 0
+    def push(self, time, priority, event):
+        heapq.heappush(self.heap, (time, priority, next(self.counter), event))
 
-    def getTxCount(self):
-        return self.txCount
+    def pop(self):
+        """
+        Remove and return the next entry (time, priority, seq, event)
+        """
+        return heapq.heappop(self.heap)
 
-    def getRxCount(self):
-        return self.rxCount
+    def peek(self):
+        """
+        Return the next entry without removing it
+        """
+        return self.heap[0]
 
-    def offerMedium(self, medium):
+    def compact(self, keep):
+        """
+        Drop all entries with events for which keep(event) is False
+        """
+        self.heap = [entry for entry in self.heap if keep(entry[3])]
+        heapq.heapify(self.heap)
 
-        if len(self.txQueue) > 0:
 
-            # retrieve next message (and corresponding receiver) from TX queue
-            message, receiver = self.txQueue.popleft()[:2]
+class CalendarQueue(EventCalendar):
+    """
+    This is a calendar queue (R. Brown, 1988) to be used as an event calendar
+    of the scheduler. Pending events are hashed by time into a ring of
+    buckets ("days") of equal width, each bucket being a binary heap. The
+    bucket width is re-estimated from the separation of distinct event
+    times whenever the number of buckets is adapted to the number of pending
+    events, such that a bucket typically holds the events of only a few
+    distinct times. The ordering of events is the same as for
+    HeapEventCalendar, i.e. (time, priority, order of insertion).
+
+    Being implemented in Python, the calendar queue only outperforms the
+    heapq-based HeapEventCalendar for about 10^6 and more pending events
+    (see the 'calendar' benchmark).
+    """
 
-            # track the number of bytes transmitted
-            if isinstance(message, ProtocolMessage):
-                self.txCount += message.getLength()
+    minBuckets = 2
 
-            # initiate message transmission
-            medium.initiateMsgTX(message, self, receiver)
+    def __init__(self, buckets=2, width=1.):
+        self.counter = itertools.count()
+        self.size = 0
+        # the time of the most recently dequeued event (no event
+        # earlier than this will ever be enqueued)
+        self.lastTime = 0.
+        self.setup(max(buckets, CalendarQueue.minBuckets), width, 0.)
 
-            # We took access to the medium
-            return True
+    def setup(self, nbuckets, width, time):
+        """
+        (Re)initialise the ring of buckets such that the current
+        bucket is the one containing <time>
+        """
+        self.buckets = [[] for i in range(nbuckets)]
+        self.nbuckets = nbuckets
+        self.width = float(width)
+        # the absolute number of the current bucket ("day")
+        self.day = int(time / self.width)
+
+        # the thresholds for adapting the number of buckets
+        self.growSize = 2 * nbuckets
+        self.shrinkSize = nbuckets // 2 - 2
+
+        # statistics used to detect a bucket width that does not fit anymore
+        self.pops = 0
+        self.skipped = 0
+        self.crowded = 0
+    def __len__(self):
+        return self.size
+
+    def push(self, time, priority, event):
+        entry = (time, priority, next(self.counter), event)
+        heapq.heappush(self.buckets[int(time / self.width) % self.nbuckets], entry)
+        self.size += 1
+        if self.size > self.growSize:
+            self.resize(2 * self.nbuckets)
+
+    def pop(self):
+        """
+        Remove and return the next entry (time, priority, seq, event)
+        """
 
-        else:
+        if not self.size:
+            raise IndexError('pop from empty calendar queue')
+
+        nbuckets = self.nbuckets
+        bucket, day = self.findNext()
+        entry = heapq.heappop(bucket)
+        self.pops += 1
+        self.skipped += day - self.day
+        if bucket and bucket[0][0] != entry[0]:
+            # (events with the same time cannot be spread by any width)
+            self.crowded += len(bucket)
+        self.day = day
+        self.lastTime = entry[0]
+        self.size -= 1
+
+        if self.size < self.shrinkSize and nbuckets > CalendarQueue.minBuckets:
+            self.resize(nbuckets // 2)
+        elif self.pops > nbuckets and (self.skipped > 4 * self.pops
+                or self.crowded > 4 * self.pops):
+            # the distribution of events has changed such that
+            # the bucket width needs to be adapted
+            self.resize(nbuckets)
+
+        return entry
+
+    def peek(self):
+        """
+        Return the next entry without removing it
+        """
+        if not self.size:
+            raise IndexError('peek into empty calendar queue')
+        return self.findNext()[0][0]
 
-            # Don't need access to the medium
-            return False
+    def findNext(self):
+        """
+        Return the bucket holding the next entry and its day
+        """
 
-    # called by subclasses of ProtocolAgent
-    def scheduleMsgTX(self, message, receiver=None):
+        buckets = self.buckets
+        nbuckets = self.nbuckets
+        width = self.width
 
-        self.log('Scheduling message {0} for transmission'.format(str(message)))                
+        # scan the buckets for an event of the current "year"
+        day = self.day
+        lastDay = day + nbuckets
+        while day < lastDay:
+            bucket = buckets[day % nbuckets]
+            if bucket and int(bucket[0][0] / width) <= day:
+                return bucket, day
+            day += 1
 
-        # add message to transmission queue
-        self.txQueue.append((message, receiver, self.scheduler.getTime()))
+        # no event within a whole year => directly search
+        # for the bucket holding the earliest event
+        bucket = min([b for b in buckets if b], key=lambda b: b[0])
+        return bucket, int(bucket[0][0] / width)
 
-        # detect message congestion
-        if len(self.txQueue):
-            times = [m[2] for m in self.txQueue]
-            if (max(times) - min(times)) > 0.:
-                self.log(TextFormatter.makeBoldYellow('Warning: Potential' + \
-                        ' message congestion for {0} (N = {1}, d = {2:>.3f}s)' \
-                                .format(self.name, len(self.txQueue),
-                                        max(times) - min(times))))
+    def entries(self):
+        return [entry for bucket in self.buckets for entry in bucket]
 
-        # trigger medium access arbitration
-        if self.medium is not None:
-            self.medium.arbitrate()
-        else:
-            self.log('Warning: No medium available')
+    def compact(self, keep):
+        """
+        Drop all entries with events for which keep(event) is False
+        """
+        for i, bucket in enumerate(self.buckets):
+            self.buckets[i] = [entry for entry in bucket if keep(entry[3])]
+            heapq.heapify(self.buckets[i])
+        self.size = sum([len(bucket) for bucket in self.buckets])
+        if self.size < self.shrinkSize and self.nbuckets > CalendarQueue.minBuckets:
+            self.resize(self.nbuckets // 2)
+
+    def estimateWidth(self):
+        """
+        Estimate a suitable bucket width from the separation of the
+        distinct event times at the head of the queue (cf. R. Brown, 1988)
+        """
 
-    # called by Medium class
-    def receive(self, message, sender):
+        times = heapq.nsmallest(25, set([entry[0] for entry in self.entries()]))
+        seps = [b - a for a, b in zip(times[:-1], times[1:])]
+        if not seps:
+            return self.width
 
-        # track the number of bytes received
-        if isinstance(message, ProtocolMessage):
-            self.rxCount += message.getLength()
+        # ignore separations that are much larger than the average
+        avg = sum(seps) / len(seps)
+        seps = [sep for sep in seps if sep <= 2. * avg]
+        avg = sum(seps) / len(seps)
+        return 3. * avg if avg > 0. else self.width
 
-        # sender is agent object instance
-        self.log(TextFormatter.makeBoldGreen(
-                '<-- received message {1} from {2}'.format(
-                        self.name, str(message), sender.getName())))
+    def resize(self, nbuckets):
+        entries = self.entries()
+        self.setup(max(nbuckets, CalendarQueue.minBuckets),
+                self.estimateWidth(), self.lastTime)
+        for entry in entries:
+            self.buckets[int(entry[0] / self.width) % self.nbuckets].append(entry)
+        for bucket in self.buckets:
+            heapq.heapify(bucket)
 
 
-class GenericClientServerAgent(ProtocolAgent):
+class StopReason(object):
+    """
+    The reasons for Scheduler.run() to return
+    """
 
-    def __init__(self, name, scheduler, flightStructure, **kwparam):
+    EMPTY = 'empty'             # there are no more pending events
+    TIME = 'time'               # the simulated time limit has been reached
+    EVENTS = 'events'           # the maximum number of events has been run
+    WALL_TIME = 'wall_time'     # the wall-clock time budget is used up
 
-        ProtocolAgent.__init__(self, name, scheduler, **kwparam)
 
-        # the flight structure defining the communication sequence
-        self.flights = flightStructure
+class Scheduler(object):
 
-        # the current flight
-        self.currentFlight = 0
+    # the available event calendars
+    backends = {
+        'heap': HeapEventCalendar,
+        'calendar': CalendarQueue,
+    }
+
+    def __init__(self, **params):
+        # the event calendar: either the name of one of the available
+        # backends or a class implementing __len__(), push(time, priority,
+        # event), pop(), peek() and compact(keep)
+        backend = params.get('backend', 'heap')
+        if isinstance(backend, str):
+            if backend not in Scheduler.backends:
+                raise Exception('Unknown scheduler backend "{0}"'.format(backend))
+            backend = Scheduler.backends[backend]
+        self.backend = backend
+
+        # compact the event calendar once cancelled events make up more than
+        # this fraction of its entries (and there are at least minTombstones)
+        self.compactRatio = params.get('compactRatio', 0.5)
+        self.minTombstones = params.get('minTombstones', 64)
+
+        # the TraceRecorder to record events to (None means no tracing);
+        # agents and media created with this scheduler use it by default
+        self.tracer = params.get('tracer', None)
+
+        # the EventProfiler to account the time spent per event to
+        # (None means no profiling)
+        self.profiler = params.get('profiler', None)
 
-        # not yet done with the communication sequence
-        self.done = False
+        self.reset()
+
+    def reset(self):
+        if hasattr(self, 'queue'):
+            # invalidate the handles of all pending events such that
+            # cancelling them later does not affect the new calendar
+            self.queue.compact(self.invalidate)
+        self.time = 0.
+        self.eventCount = 0
+        self.queue = self.backend()
+        # the number of cancelled events still in the queue
+        self.tombstones = 0
+
+    def registerEventAbs(self, event, time, priority=0):
+        """
+        Register an event at an absolute time. Returns a handle
+        that can be used to cancel the event.
+        """
+        if time < self.time:
+            raise Exception('Cannot register event in past')
+        handle = EventHandle(self, event, time)
+        self.queue.push(time, priority, handle)
+        return handle
+
+    def registerEventRel(self, event, time, priority=0):
+        return self.registerEventAbs(event, self.time + time, priority)
+
+    def getTime(self):
+        return self.time
+
+    def getEventCount(self):
+        return self.eventCount
+
+    def getPendingCount(self):
+        return len(self.queue) - self.tombstones
+
+    def cancelEvent(self, handle):
+        """
+        Account for a cancelled event (called by EventHandle.cancel())
+        """
+        self.tombstones += 1
+        if self.tombstones >= self.minTombstones and \
+                self.tombstones > self.compactRatio * len(self.queue):
+            self.compact()
+
+    @staticmethod
+    def invalidate(handle):
+        handle.event = None
+        return False
+
+    def compact(self):
+        """
+        Remove all cancelled events from the event calendar
+        """
+        self.queue.compact(lambda handle: handle.event is not None)
+        self.tombstones = 0
+
+    def done(self):
+        return len(self.queue) == self.tombstones
+
+    def empty(self):
+        return self.done()
+
+    def getNextTime(self):
+        """
+        Return the time of the next pending event (None if there is none)
+        """
+        queue = self.queue
+        while len(queue) > self.tombstones:
+            entry = queue.peek()
+            if entry[3].event is not None:
+                return entry[0]
+            # drop cancelled events on the way
+            queue.pop()
+            self.tombstones -= 1
+        return None
+
+    def runStep(self):
+        """
+        Run one single step
+        """
+
+        queue = self.queue
+        while len(queue) > self.tombstones:
+
+            # retrieve the next event from the queue
+            time, priority, seq, handle = queue.pop()
+            event = handle.event
+            if event is None:
+                # >>> the event has been cancelled >>>
+                self.tombstones -= 1
+                continue
+            handle.event = None
+
+            if time < self.time:
+                raise Exception('Cannot handle event from past')
+
+            # proceed current time to event time
+            self.time = time
+            self.eventCount += 1
+            if self.tracer is not None:
+                self.tracer.recordEvent(TraceRecorder.EVENT, time)
+
+            # execute the event
+            if self.profiler is None:
+                event.execute()
+            else:
+                profiler = self.profiler
+                start = profiler.clock()
+                event.execute()
+                profiler.record(event, profiler.clock() - start)
+            break
+
+        # return the new current time
+        return self.time
+
+    def run(self, until=None, max_events=None, wall_time=None, batch=1000):
+        """
+        Run events until there are no more pending events or one of the
+        limits is reached: the simulated time <until> (events due at <until>
+        are still run and the time then proceeds to <until>), <max_events>
+        executed events, or <wall_time> seconds of wall-clock time (checked
+        every <batch> events only). Returns the reason for stopping (see
+        StopReason). The run can be continued by calling run() again.
+        """
+
+        if until is None and max_events is None and wall_time is None:
+            while len(self.queue) > self.tombstones:
+                self.runStep()
+            return StopReason.EMPTY
+
+        if until is not None and until < self.time:
+            raise Exception('Cannot run until a time in the past')
+        deadline = None if wall_time is None else time.time() + wall_time
+
+        count = 0
+        while True:
+            if until is not None:
+                nextTime = self.getNextTime()
+                if nextTime is None or nextTime > until:
+                    self.time = until
+                    return StopReason.EMPTY if nextTime is None \
+                            else StopReason.TIME
+            elif len(self.queue) == self.tombstones:
+                return StopReason.EMPTY
+            if count == max_events:
+                return StopReason.EVENTS
+            if deadline is not None and count % batch == 0 \
+                    and time.time() >= deadline:
+                return StopReason.WALL_TIME
+            self.runStep()
+            count += 1
+
+    def runUntil(self, until, **params):
+        """
+        Run all events due until the simulated time <until> (see run())
+        """
+        return self.run(until, **params)
+
+
+def reduceMethod(method):
+    """
+    Pickle bound methods (e.g. the callbacks of pending events) by
+    the object they are bound to and the name of the method
+    """
+    if method.im_self is None:
+        return getattr, (method.im_class, method.im_func.__name__)
+    return getattr, (method.im_self, method.im_func.__name__)
+
+
+def dumpSimulation(simulation, f=None):
+    """
+    Pickle <simulation> to the file <f> (or to a string that is returned)
+    with bound methods pickled by reduceMethod. The reducer is registered
+    for the duration of the call only, so pickling elsewhere is unaffected.
+    """
+    table = copy_reg.dispatch_table
+    previous = table.get(types.MethodType)
+    table[types.MethodType] = reduceMethod
+    try:
+        if f is None:
+            return cPickle.dumps(simulation, cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump(simulation, f, cPickle.HIGHEST_PROTOCOL)
+    except (cPickle.PicklingError, TypeError) as e:
+        raise Exception('Cannot pickle the simulation ({0}): timeout '
+                'policies, onComplete callbacks and loggers must be '
+                'picklable, i.e. no lambdas or nested functions'.format(e))
+    finally:
+        if previous is None:
+            del table[types.MethodType]
+        else:
+            table[types.MethodType] = previous
+
+
+def saveCheckpoint(path, simulation):
+    """
+    Write a snapshot of <simulation> to <path>. The simulation is any
+    picklable object (e.g. a tuple or dictionary) referring to the scheduler
+    and to the media and agents of interest; everything reachable from it
+    (pending events, blocked media, queues and flight state of agents,
+    random streams) is saved. The state of the module-global random
+    generator is saved as well. Timeout policies (e.g. ExponentialTimeouts
+    and LinearTimeouts instead of lambdas), onComplete callbacks (e.g.
+    bound methods) and loggers must be picklable, i.e. module-level
+    functions, bound methods or instances of module-level classes, and
+    tracing is not supported. The snapshot is written to a temporary file
+    first such that <path> always holds a complete snapshot.
+    """
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            dumpSimulation((random.getstate(), simulation), f)
+    except:
+        # do not leave a partial snapshot behind
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+    os.rename(path + '.tmp', path)
+
+
+def loadCheckpoint(path):
+    """
+    Load a snapshot written by saveCheckpoint() and return the simulation.
+    Loading the same snapshot several times yields independent copies of
+    the simulation that can be continued separately.
+    """
+    with open(path, 'rb') as f:
+        state, simulation = cPickle.load(f)
+    random.setstate(state)
+    return simulation
+
+
+class Checkpointer(Event):
+    """
+    This event writes a snapshot of <simulation> (see saveCheckpoint) to
+    <path> every <interval> seconds of simulated time. If <wall_interval> is
+    given, a snapshot is only written if at least <wall_interval> seconds of
+    wall-clock time have passed since the previous one. The checkpointer
+    stops once it is the only pending event such that it does not keep an
+    otherwise finished simulation going (the simulated time then ends at
+    the time of its last check). Use start() to schedule the first snapshot.
+    """
+
+    def __init__(self, scheduler, path, simulation, interval, **params):
+        self.scheduler = scheduler
+        self.path = path
+        self.simulation = simulation
+        self.interval = interval
+        self.wall_interval = params.get('wall_interval', None)
+        self.lastWallTime = None
+        self.count = 0
+
+    def start(self, at=None):
+        """
+        Schedule the first snapshot at simulated time <at> (default:
+        after one interval)
+        """
+        self.lastWallTime = time.time()
+        if at is None:
+            at = self.scheduler.getTime() + self.interval
+        self.scheduler.registerEventAbs(self, at)
+
+    def getCount(self):
+        return self.count
+
+    def execute(self):
+        if self.scheduler.getPendingCount() == 0:
+            return
+
+        # schedule the next snapshot first such that it is part of this one
+        self.scheduler.registerEventRel(self, self.interval)
+
+        now = time.time()
+        if self.wall_interval is not None and \
+                now - self.lastWallTime < self.wall_interval:
+            return
+        self.lastWallTime = now
+        self.count += 1
+        saveCheckpoint(self.path, self.simulation)
+
+
+class Message(object):
+    """
+    This is the base class for messages. Messages are immutable values, so a
+    message can be shared by any number of transmissions and agents.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return '[{0}]'.format(self.name)
+
+    def getName(self):
+        return self.name
+
+    def transmission(self, seq):
+        """
+        Return the instance to put on the medium for the <seq>-th
+        transmission of this message (plain messages are simply shared)
+        """
+        return self
+
+
+class ProtocolMessage(Message):
+
+    __slots__ = ('length',)
+
+    def __init__(self, message, length):
+        Message.__init__(self, message)
+        self.length = length
+
+    def __str__(self):
+        return '<{0}>(L={1})'.format(self.getName(), self.length)
+
+    def getLength(self):
+        return self.length
+
+    def fragment(self, lenPayload, lenFixed):
+        
+        fragments = []
+
+        msgLen = self.getLength()
+        while msgLen > 0:
+            lenFrag = min(msgLen, lenPayload)
+            msgLen -= lenFrag
+            fragments.append(ProtocolMessage('{0}.f{1}'.format(
+                    self.getName(), len(fragments)), lenFrag + lenFixed))
+
+        return fragments
+
+    def transmission(self, seq):
+        """
+        Return a lightweight envelope for the <seq>-th transmission of
+        this message (instead of copying the message). Instances of
+        subclasses are copied as before since they may carry further
+        attributes and receivers may check for their type.
+        """
+        if type(self) is not ProtocolMessage:
+            return copy.deepcopy(self)
+        return MessageTransmission(self, seq)
+
+
+class MessageTransmission(ProtocolMessage):
+    """
+    This class represents a single transmission of a protocol message. It
+    references the shared message (the template) and carries the number of
+    the transmission, such that receivers can tell copies apart.
+    """
+
+    __slots__ = ('template', 'seq')
+
+    def __init__(self, template, seq):
+        # share name and length with the template (nothing is copied)
+        self.name = template.name
+        self.length = template.length
+        self.template = template
+        self.seq = seq
+
+    def getTemplate(self):
+        return self.template
+
+    def getSeq(self):
+        return self.seq
+
+    def transmission(self, seq):
+        return MessageTransmission(self.template, seq)
+
+
+class RoutedMessage(ProtocolMessage):
+    """
+    This class represents a message travelling across a network of media
+    from a <source> to a <destination> agent (given by name). The message
+    carries the <payload> and adds <overhead> bytes of header to its length.
+    """
+
+    __slots__ = ('payload', 'source', 'destination')
+
+    def __init__(self, payload, source, destination, overhead=0):
+        ProtocolMessage.__init__(self, payload.getName(),
+                payload.getLength() + overhead)
+        self.payload = payload
+        self.source = source
+        self.destination = destination
+
+    def __str__(self):
+        return '<{0}>(L={1}, {2} -> {3})'.format(self.getName(), self.length,
+                self.source, self.destination)
+
+    def getPayload(self):
+        return self.payload
+
+    def getSource(self):
+        return self.source
+
+    def getDestination(self):
+        return self.destination
+
+    def transmission(self, seq):
+        # routed messages are created per transmission anyway
+        return self
+
+
+class Agent(Loggable):
+
+    def __init__(self, name, scheduler, **params):
+        self.name = name
+        self.scheduler = scheduler
+        self.logger = params.get('logger', None)
+        self.tracer = params.get('tracer', scheduler.tracer)
+        self.medium = None
+
+        medium = params.get('medium', None)
+        if medium:
+            medium.registerAgent(self)
+
+    def getName(self):
+        return self.name
+
+    def registerMedium(self, medium):
+        if self.medium:
+            raise Exception('Agent "{0}" already registered with medium'.format(self.name))
+        self.medium = medium
+
+    def unregisterMedium(self, medium):
+        if self.medium is not medium:
+            raise Exception('Agent "{0}" not registered with medium'.format(self.name))
+        self.medium = None
+
+    def getMedia(self):
+        return [self.medium] if self.medium is not None else []
+
+    def offerMedium(self, medium):
+        """
+        Called by the medium to offer access to it; returns True if the agent
+        took the medium. The medium only offers itself to agents it considers
+        ready: agents are ready once registered and may call
+        medium.notifyIdle() when there is nothing to do and
+        medium.notifyReady() once there is something to do again.
+        """
+        return False
+
+    def receive(self, message, sender):
+        pass
+
+
+class BlockingAgent(Agent):
+
+    def __init__(self, name, scheduler, frequency, duration, **params):
+        Agent.__init__(self, name, scheduler, **params)
+        self.running = False
+        self.queue = 0
+        self.withhold = False
+        self.nextTick = None
+
+        # Whether blocking request shall be piled up
+        self.queuing = params.get('queuing', False)
+
+        # The frequency of blocking requests in requests per second
+        self.frequency = frequency
+
+        # The duration of each blocking request in seconds
+        self.duration = duration
+
+        # The minimum separation time between blocking request in seconds
+        self.min_sep_time = params.get('min_sep_time', 0)
+
+        if (1. / self.frequency) <= (float(self.duration) + self.min_sep_time):
+            raise Exception('Blocking frequency higher than' + 
+                    ' duration and minimum separation time allows')
+
+    def start(self):
+        self.queue = 0
+        self.running = True
+        self.tick()
+
+    def stop(self):
+        self.queue = 0
+        self.running = False
+        if self.medium is not None:
+            self.medium.notifyIdle(self)
+        if self.nextTick is not None:
+            self.nextTick.cancel()
+            self.nextTick = None
+
+    def tick(self):
+
+        if not self.running:
+            return
+
+        if self.queuing:
+            # Pile-up blocking requests
+            self.queue += 1
+        else:
+            # Request blocking
+            self.queue = 1
+
+        # Trigger arbitration of medium to ensure medium access
+        self.medium.notifyReady(self)
+        self.medium.arbitrate()
+
+        # register next blocking request
+        self.nextTick = self.scheduler.registerEventRel(
+                Callback(self.tick), 1. / self.frequency)
+
+    def offerMedium(self, medium):
+
+        if not self.withhold and self.queue > 0:        
+
+            # Block the medium
+            self.queue -= 1
+            if self.queue == 0:
+                medium.notifyIdle(self)
+            medium.blockMedium(self, self.duration)
+
+            if self.queue > 0:
+                self.log('Blocking medium for {0:f}s ({1} blocking '
+                        'requests left)', self.duration, self.queue)
+            else:
+                self.log('Blocking medium for {0:f}s', self.duration)
+
+            # Ensure minimum separation time
+            if self.min_sep_time:
+                self.withhold = True
+                self.scheduler.registerEventRel(Callback(
+                        self.unWithhold, medium),
+                        float(self.duration) + self.min_sep_time)
+
+            return True
+        else:
+            if self.queue == 0:
+                medium.notifyIdle(self)
+            return False
+
+    def unWithhold(self, medium):
+        self.withhold = False
+        medium.arbitrate()
+
+
+class ProtocolAgent(Agent):
+
+    def __init__(self, name, scheduler, **params):
+        Agent.__init__(self, name, scheduler, **params)
+        self.txQueue = collections.deque()
+        self.txCount = 0
+        self.rxCount = 0
+
+        # congestion statistics of the TX queue (updated incrementally)
+        self.maxQueueDepth = 0
+        self.maxQueueDelay = 0.
+        self.congestionCount = 0
+        # the integral of the queue depth over time (up to lastQueueChange)
+        self.queueDepthIntegral = 0.
+        self.lastQueueChange = scheduler.getTime()
+        self.queueStatsStart = scheduler.getTime()
+
+    def getTxCount(self):
+        return self.txCount
+
+    def getRxCount(self):
+        return self.rxCount
+
+    def getMaxQueueDepth(self):
+        return self.maxQueueDepth
+
+    def getMaxQueueDelay(self):
+        """
+        Return the longest time a message spent (or is spending) in the TX queue
+        """
+        if self.txQueue:
+            return max(self.maxQueueDelay,
+                    self.scheduler.getTime() - self.txQueue[0][2])
+        return self.maxQueueDelay
+
+    def getAvgQueueDepth(self):
+        """
+        Return the time-weighted average depth of the TX queue
+        """
+        now = self.scheduler.getTime()
+        if now <= self.queueStatsStart:
+            return float(len(self.txQueue))
+        integral = self.queueDepthIntegral + \
+                len(self.txQueue) * (now - self.lastQueueChange)
+        return integral / (now - self.queueStatsStart)
+
+    def getCongestionStats(self):
+        return {
+            'maxQueueDepth': self.getMaxQueueDepth(),
+            'maxQueueDelay': self.getMaxQueueDelay(),
+            'avgQueueDepth': self.getAvgQueueDepth(),
+            'congestionCount': self.congestionCount,
+        }
+
+    def updateQueueDepthIntegral(self, now):
+        # call before the depth of the TX queue changes
+        self.queueDepthIntegral += len(self.txQueue) * (now - self.lastQueueChange)
+        self.lastQueueChange = now
+
+    def offerMedium(self, medium):
+
+        if len(self.txQueue) > 0:
+
+            # retrieve next message (and corresponding receiver) from TX queue
+            now = self.scheduler.getTime()
+            self.updateQueueDepthIntegral(now)
+            message, receiver, queued = self.txQueue.popleft()
+            if now - queued > self.maxQueueDelay:
+                self.maxQueueDelay = now - queued
+            if not self.txQueue:
+                medium.notifyIdle(self)
+
+            # track the number of bytes transmitted
+            if isinstance(message, ProtocolMessage):
+                self.txCount += message.getLength()
+
+            # initiate message transmission
+            medium.initiateMsgTX(message, self, receiver)
+
+            # We took access to the medium
+            return True
+
+        else:
+
+            # Don't need access to the medium
+            medium.notifyIdle(self)
+            return False
+
+    # called by subclasses of ProtocolAgent
+    def scheduleMsgTX(self, message, receiver=None):
+
+        self.log('Scheduling message {0} for transmission', message,
+                level=LogLevel.DEBUG)
+        if self.tracer is not None:
+            self.tracer.recordEvent(TraceRecorder.ENQUEUE,
+                    self.scheduler.getTime(), self.name, message)
+
+        # add message to transmission queue
+        now = self.scheduler.getTime()
+        self.updateQueueDepthIntegral(now)
+        self.txQueue.append((message, receiver, now))
+        if len(self.txQueue) > self.maxQueueDepth:
+            self.maxQueueDepth = len(self.txQueue)
+
+        # detect message congestion (messages are queued in order of
+        # time, so the oldest message is the one at the head of the queue)
+        delay = now - self.txQueue[0][2]
+        if delay > 0.:
+            self.congestionCount += 1
+            self.log('Warning: Potential message congestion for '
+                    '{0} (N = {1}, d = {2:>.3f}s)', self.name,
+                            len(self.txQueue), delay, level=LogLevel.WARNING,
+                                    style=TextFormatter.makeBoldYellow)
+
+        # trigger medium access arbitration
+        if self.medium is not None:
+            self.medium.notifyReady(self)
+            self.medium.arbitrate()
+        else:
+            self.log('Warning: No medium available', level=LogLevel.WARNING)
+
+    def scheduleRoutedMsgTX(self, message, destination):
+        """
+        Schedule <message> for transmission to the agent named <destination>
+        across the network the agent's medium is part of
+        """
+        network = self.medium.network if self.medium is not None else None
+        if network is None:
+            raise Exception('Agent "{0}" is not attached to a network' \
+                    .format(self.name))
+        medium, hop = network.route(self, destination)
+        self.scheduleMsgTX(RoutedMessage(message, self.name, destination,
+                network.header_length), hop)
+
+    # called by Medium class
+    def receive(self, message, sender):
+
+        # track the number of bytes received
+        if isinstance(message, ProtocolMessage):
+            self.rxCount += message.getLength()
+        if self.tracer is not None:
+            self.tracer.recordEvent(TraceRecorder.RX,
+                    self.scheduler.getTime(), self.name, message)
+
+        # sender is agent object instance
+        self.log('<-- received message {0} from {1}', message,
+                sender.getName(), style=TextFormatter.makeBoldGreen)
+
+
+class GenericClientServerAgent(ProtocolAgent):
+
+    def __init__(self, name, scheduler, flightStructure, **kwparam):
+
+        ProtocolAgent.__init__(self, name, scheduler, **kwparam)
+
+        # the flight structure defining the communication sequence
+        self.flights = flightStructure
+
+        # the current flight
+        self.currentFlight = 0
+
+        # not yet done with the communication sequence
+        self.done = False
 
         # the number of transmissions for each flight (one entry per flight)
         self.transmissions = [0] * len(flightStructure)
 
+        # the pending retransmission timeout for each flight (one entry per flight)
+        self.timers = [None] * len(flightStructure)
+
         # keep track of the number of times messages have been received
         self.receptions = [[0] * len(flight) for flight in flightStructure]
 
         # keep track of the time when a message has been received first
         self.first_receptions = [[None] * len(flight) for flight in flightStructure]
 
+        # the index of each message within its flight by message name (one
+        # dictionary per flight; the first message wins if names repeat)
+        self.msgIndices = []
+        for flight in flightStructure:
+            indices = {}
+            for i, msg in enumerate(flight):
+                indices.setdefault(msg.getName(), i)
+            self.msgIndices.append(indices)
+
+        # the number of messages not received yet (one entry per flight)
+        self.missing = [len(flight) for flight in flightStructure]
+
         # Flag for stopping Retransmissions
         
         self.Retransmission_flag=False
@@ -408,6 +1485,7 @@ class GenericClientServerAgent(ProtocolAgent):
         if len(flightStructure) > 1:
             # >>> there is more than one flight
             self.receptions_stl_flight = [False] * len(flightStructure[-2])
+            self.stlMissing = len(flightStructure[-2])
 
         # the retransmission timeout function
         self.timeouts = kwparam.get('timeouts', None)
@@ -415,6 +1493,10 @@ class GenericClientServerAgent(ProtocolAgent):
         # communictation sequence complete callback
         self.onComplete = kwparam.get('onComplete', None)
 
+        # the name of the agent to talk to across a network
+        # (None means broadcasting on the agent's own medium)
+        self.peer = kwparam.get('peer', None)
+
     def getTimeout(self, index):
         if self.timeouts:
             return self.timeouts(index)
@@ -443,7 +1525,7 @@ class GenericClientServerAgent(ProtocolAgent):
         # move on to the next flight if this is not the last flight
         if (self.currentFlight + 1) < len(self.flights):
             self.currentFlight += 1
-            self.log('Now at flight #{0}'.format(self.currentFlight + 1))
+            self.log('Now at flight #{0}', self.currentFlight + 1)
 
     def transmitFlight(self, flight):
 
@@ -451,22 +1533,25 @@ class GenericClientServerAgent(ProtocolAgent):
             raise Exception('Trying to transmit the wrong flight!')
 
         if self.transmissions[flight] == 0:
-            self.log('Transmitting flight #{0}'.format(flight + 1))
+            self.log('Transmitting flight #{0}', flight + 1)
         else:
-            self.log('Retransmitting flight #{0} (transmitted {1} ' \
-                    .format(flight + 1, self.transmissions[flight]) + 
-                            'time(s) before)')
+            self.log('Retransmitting flight #{0} (transmitted {1} '
+                    'time(s) before)', flight + 1, self.transmissions[flight])
 
         # transmit messages one by one
         for msg in self.flights[flight]:
-            self.scheduleMsgTX(copy.deepcopy(msg))
+            if self.peer is None:
+                self.scheduleMsgTX(msg.transmission(self.transmissions[flight]))
+            else:
+                self.scheduleRoutedMsgTX(msg.transmission(
+                        self.transmissions[flight]), self.peer)
 
         # don't trigger the retransmission of the last flight using timeout
         if (flight + 1) < len(self.flights):
             timeout = self.getTimeout(self.transmissions[flight])
             if timeout is not None:
-                self.scheduler.registerEventRel(Callback(
-                        self.checkFlight, flight=flight), timeout)
+                self.timers[flight] = self.scheduler.registerEventRel(Callback(
+                        self.checkFlight, flight), timeout)
 
         # remember that this flight has been (re)transmitted 
         self.transmissions[flight] += 1
@@ -474,6 +1559,7 @@ class GenericClientServerAgent(ProtocolAgent):
         # clear reception tracking of second-to-last flight
         if len(self.flights) > 1 and (flight + 1) == len(self.flights):
             self.receptions_stl_flight = [False] * len(self.flights[-2])
+            self.stlMissing = len(self.flights[-2])
 
         # is this flight transmitted for the first time ...
         # equivalently: if self.transmissions[flight] == 0
@@ -482,15 +1568,23 @@ class GenericClientServerAgent(ProtocolAgent):
             # move on to the next flight if this is not the last flight
             self.gotoNextFlight()
 
-    def checkFlight(self, flight):
+    def isFlightAcknowledged(self, flight):
         # the second-to-last flight has to be treated differently
         if len(self.flights) > 1 and (flight + 2) == len(self.flights):
-            # retransmit if at least one message is missing
-            doRetransmit = min(self.receptions[flight + 1]) == 0
+            # acknowledged if every message of the next flight has been received
+            return self.missing[flight + 1] == 0
         else:
-            # retransmit if every message is missing
-            doRetransmit = max(self.receptions[flight + 1]) == 0
-        if doRetransmit:
+            # acknowledged if at least one message of the next flight has been received
+            return self.missing[flight + 1] < len(self.flights[flight + 1])
+
+    def cancelTimeout(self, flight):
+        if self.timers[flight] is not None:
+            self.timers[flight].cancel()
+            self.timers[flight] = None
+
+    def checkFlight(self, flight):
+        self.timers[flight] = None
+        if not self.isFlightAcknowledged(flight):
             # retransmit
             self.transmitFlight(flight)
 
@@ -502,98 +1596,210 @@ class GenericClientServerAgent(ProtocolAgent):
             # >>> we are handling the last flight and are supposed to potentially retransmit it >>>
             expectedFlight -= 1
 
-        # the list of expected messages in the current flight
-        expectedMsgs = [msg.getName() for msg in self.flights[expectedFlight]]
+        # look up the message in the expected flight
+        msgIndex = self.msgIndices[expectedFlight].get(message.getName())
 
         # detect unexpected messages
-        if message.getName() not in expectedMsgs:
+        if msgIndex is None:
 
             # >>> We received an unexpected message
             # (probably from a previous flight) >>>
-            self.log(('Received unexpected message "{0}". '
-                    + 'Expecting one of {1}').format(message.getName(), ', ' \
-                            .join(['<{0}>'. format(msg) for msg in expectedMsgs])))
+            self.log(lambda: 'Received unexpected message "{0}". ' \
+                    'Expecting one of {1}'.format(message.getName(), ', ' \
+                            .join(['<{0}>'.format(msg.getName()) \
+                                    for msg in self.flights[expectedFlight]])))
 
             # Just ignore it
             return
 
         # remember that (and when) the message has been received once (more)
-        msgIndex = expectedMsgs.index(message.getName())
-        self.receptions[expectedFlight][msgIndex] += 1
-        if self.first_receptions[expectedFlight][msgIndex] is None:
+        if self.receptions[expectedFlight][msgIndex] == 0:
+            self.missing[expectedFlight] -= 1
             self.first_receptions[expectedFlight][msgIndex] = self.scheduler.getTime()
+        self.receptions[expectedFlight][msgIndex] += 1
 
         # keep track of receptions of second-to-last flight
         if len(self.flights) > 1 and (expectedFlight + 2) == len(self.flights):
-            self.receptions_stl_flight[msgIndex] = True
+            if not self.receptions_stl_flight[msgIndex]:
+                self.receptions_stl_flight[msgIndex] = True
+                self.stlMissing -= 1
+
+        # the reception might acknowledge our previous flight
+        # => no need to keep its retransmission timeout pending
+        if expectedFlight > 0 and self.isFlightAcknowledged(expectedFlight - 1):
+            self.cancelTimeout(expectedFlight - 1)
 
         if (self.currentFlight  + 1) < len(self.flights):
             # >>> we are NOT handling the last flight >>>
             # check whether flight has been received completely ...
-            if min(self.receptions[self.currentFlight]) > 0:
+            if self.missing[self.currentFlight] == 0:
                 # >>> YES >>>
-                self.log('Flight #{0} has been received completely' \
-                        .format(self.currentFlight + 1))
+                self.log('Flight #{0} has been received completely',
+                        self.currentFlight + 1)
                 # move on to the next flight
                 self.gotoNextFlight()
                 # transmit next flight
                 self.transmitFlight(self.currentFlight)
             else:
                 # >>> NO >>>
-                missing = ', '.join(['<{0}>'.format(expectedMsgs[i]) \
-                        for i in range(len(expectedMsgs)) \
-                                if self.receptions[self.currentFlight][i] == 0])
-                self.log('Messages still missing from flight #{0}: {1}' \
-                        .format(self.currentFlight + 1, missing))
+                self.log(lambda: 'Messages still missing from flight ' \
+                        '#{0}: {1}'.format(self.currentFlight + 1, ', '.join([
+                                '<{0}>'.format(msg.getName()) for msg, n in zip(
+                                        self.flights[self.currentFlight],
+                                        self.receptions[self.currentFlight])
+                                if n == 0])))
 
         elif self.isTXFlight(self.currentFlight):
             # >>> we received a retransmission of the second-to-last flight
             # retransmit the last flight if we re-received the second-to-last flight completely
-            if len(self.flights) > 1 and self.receptions_stl_flight.count(False) == 0:
-                self.log(('The second-to-last flight (flight #{0}) has ' +
-                        'been re-received completely').format(expectedFlight + 1))
+            if len(self.flights) > 1 and self.stlMissing == 0:
+                self.log('The second-to-last flight (flight #{0}) has '
+                        'been re-received completely', expectedFlight + 1)
                 # do retransmission
                 self.transmitFlight(self.currentFlight)
 
         # here: self.currentFlight == expectedFlight
-        elif min(self.receptions[self.currentFlight]) > 0 and not self.done:
+        elif self.missing[self.currentFlight] == 0 and not self.done:
             # >>> we received the last flight completely
-            self.log('Communication sequence completed at time {0:>.3f}s' \
-                    .format(self.scheduler.getTime()))
+            self.log('Communication sequence completed at time {0:>.3f}s',
+                    self.scheduler.getTime())
             self.done = True
             self.doneAtTime = self.scheduler.getTime()
             if self.onComplete:
                 self.onComplete()
 
 
-class GenericClientAgent(GenericClientServerAgent):
+class GenericClientAgent(GenericClientServerAgent):
+
+
+    def __init__(self, name, scheduler, flightStructure, **kwparam):
+        GenericClientServerAgent.__init__(
+                self, name, scheduler, flightStructure, **kwparam)
+
+    def trigger(self):
+        self.currentFlight = 0
+        self.transmitFlight(self.currentFlight)
+
+    def isTXFlight(self, flight):
+        # Clients transmit even flight numbers (0, 2, ...)
+        return (flight % 2) == 0
+
+
+class GenericServerAgent(GenericClientServerAgent):
+
+    def __init__(self, name, scheduler, flightStructure, **kwparam):
+        GenericClientServerAgent.__init__(
+                self, name, scheduler, flightStructure, **kwparam)
+
+    def isTXFlight(self, flight):
+        # Server transmit odd flight numbers (1, 3, ...)
+        return (flight % 2) == 1
+
+
+class GatewayAgent(Agent):
+    """
+    An agent attached to several media (given as <media>) that forwards
+    routed messages between them. Forwarded messages are queued per medium
+    until the respective medium is offered to the gateway.
+    """
+
+    def __init__(self, name, scheduler, **params):
+        self.media = []
+        self.txQueues = {}
+        Agent.__init__(self, name, scheduler, **params)
+        self.txCount = 0
+        self.rxCount = 0
+        self.forwardCount = 0
+        self.maxQueueDepth = 0
+
+        for medium in params.get('media', []):
+            medium.registerAgent(self)
+
+    def getTxCount(self):
+        return self.txCount
+
+    def getRxCount(self):
+        return self.rxCount
+
+    def getForwardCount(self):
+        return self.forwardCount
+
+    def getMaxQueueDepth(self):
+        return self.maxQueueDepth
+
+    def getQueueDepth(self, medium):
+        return len(self.txQueues[medium])
+
+    def getMedia(self):
+        return self.media
+
+    def registerMedium(self, medium):
+        if medium in self.txQueues:
+            raise Exception('Gateway "{0}" already registered with medium' \
+                    .format(self.name))
+        self.media.append(medium)
+        self.txQueues[medium] = collections.deque()
+
+    def unregisterMedium(self, medium):
+        if medium not in self.txQueues:
+            raise Exception('Gateway "{0}" not registered with medium' \
+                    .format(self.name))
+        # messages still queued for the medium are dropped
+        self.media.remove(medium)
+        del self.txQueues[medium]
+
+    def offerMedium(self, medium):
+
+        txQueue = self.txQueues[medium]
+        if txQueue:
+            message, receiver = txQueue.popleft()
+            if not txQueue:
+                medium.notifyIdle(self)
+            self.txCount += message.getLength()
+            medium.initiateMsgTX(message, self, receiver)
+            return True
+        else:
+            medium.notifyIdle(self)
+            return False
 
+    def receive(self, message, sender):
 
-    def __init__(self, name, scheduler, flightStructure, **kwparam):
-        GenericClientServerAgent.__init__(
-                self, name, scheduler, flightStructure, **kwparam)
+        if isinstance(message, ProtocolMessage):
+            self.rxCount += message.getLength()
+        if self.tracer is not None:
+            self.tracer.recordEvent(TraceRecorder.RX,
+                    self.scheduler.getTime(), self.name, message)
 
-    def trigger(self):
-        self.currentFlight = 0
-        self.transmitFlight(self.currentFlight)
+        if isinstance(message, RoutedMessage) and \
+                message.getDestination() != self.name:
+            self.forward(message)
+        else:
+            self.log('<-- received message {0} from {1}', message,
+                    sender.getName(), style=TextFormatter.makeBoldGreen)
 
-    def isTXFlight(self, flight):
-        # Clients transmit even flight numbers (0, 2, ...)
-        return (flight % 2) == 0
+    def forward(self, message):
 
+        # the network is the same for all media of the gateway
+        network = self.media[0].network
+        medium, hop = network.route(self, message.getDestination())
 
-class GenericServerAgent(GenericClientServerAgent):
+        self.log('Forwarding message {0} to {1} via {2}', message,
+                hop.getName(), medium.getName(), level=LogLevel.DEBUG)
+        if self.tracer is not None:
+            self.tracer.recordEvent(TraceRecorder.ENQUEUE,
+                    self.scheduler.getTime(), self.name, message)
 
-    def __init__(self, name, scheduler, flightStructure, **kwparam):
-        GenericClientServerAgent.__init__(
-                self, name, scheduler, flightStructure, **kwparam)
+        self.forwardCount += 1
+        txQueue = self.txQueues[medium]
+        txQueue.append((message, hop))
+        if len(txQueue) > self.maxQueueDepth:
+            self.maxQueueDepth = len(txQueue)
 
-    def isTXFlight(self, flight):
-        # Server transmit odd flight numbers (1, 3, ...)
-        return (flight % 2) == 1
+        medium.notifyReady(self)
+        medium.arbitrate()
 
 
-class Medium(object):
+class Medium(Loggable):
 
     priorityReceive = 0
     priorityUnblock = 1
@@ -601,10 +1807,26 @@ class Medium(object):
     def __init__(self, scheduler, **params):
         self.scheduler = scheduler
         self.agents = {}
+        # the agents in the order the medium is offered to them
+        # and their ranks (the sort keys, in the same order)
         self.sortedAgents = []
+        self.sortedRanks = []
+        # the rank of each agent and the agent of each rank
+        self.agentRanks = {}
+        self.rankedAgents = {}
+        # the sorted ranks of agents ready to access the medium
+        self.readyRanks = []
+        self.registrations = 0
+        # the agents in the order of registration and the receivers of
+        # broadcasts by each sender (built on demand, reset on changes)
+        self.registeredAgents = []
+        self.broadcastReceivers = {}
         self.blocked = False
         self.usage = {}
 
+        # the network the medium is part of (set by Network.addMedium)
+        self.network = None
+
         self.name = params.get('name', 'Medium')
 
         # the data rate in bytes/second, None means 'unlimited'
@@ -615,27 +1837,114 @@ class Medium(object):
         self.bit_loss_rate = params.get('bit_loss_rate', 0.)
         self.inter_msg_time = params.get('inter_msg_time', 0.)
         self.logger = params.get('logger', None)
+        self.tracer = params.get('tracer', scheduler.tracer)
+
+        # the medium's own random stream used for loss decisions: either
+        # given as <rng> (a random.Random) or created from <seed>
+        rng = params.get('rng', None)
+        if rng is None:
+            rng = makeRandomStream(params.get('seed', None), self.name)
+        self.setRandomStream(rng)
 
     def getName(self):
         return self.name
 
+    def setRandomStream(self, rng):
+        self.rng = rng
+        # keep the bound method to save attribute lookups per message
+        self.random = rng.random
+
+    def reseed(self, seed):
+        """
+        Continue with a fresh random stream derived from <seed>
+        """
+        self.setRandomStream(makeRandomStream(seed, self.name))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the bound method of the random stream cannot be pickled
+        # (the stream itself is kept)
+        del state['random']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.random = self.rng.random
+
     def registerAgent(self, agent, priority=None):
+        """
+        Register an agent with an optional <priority>. The medium is offered
+        to agents with a priority first (in ascending priority), followed by
+        agents without. Agents of equal priority (and agents without) are
+        offered the medium in the order of their registration. This
+        replaces the former, arbitrary order of the agent dictionary, so
+        register agents in the order they shall be offered the medium.
+        """
         if agent.getName() in self.agents:
             raise Exception('Agent "{0}" already registered'.format(agent.getName()))
         agent.registerMedium(self)
         self.agents[agent.getName()] = agent, priority
-        self.sortAgents()
-
-    def sortAgents(self):
 
-        # sort agents with assigned priority
-        agents = [(p, a) for a, p in self.agents.values() if p is not None]
-        sortedAgents = map(lambda (p, a): a, sorted(agents))
-
-        # append agents without assigned priority
-        sortedAgents += [a for a, p in self.agents.values() if p is None]
+        # agents with assigned priority come first (ascending priority),
+        # followed by agents without; ties keep the order of registration
+        self.registrations += 1
+        if priority is not None:
+            rank = (0, priority, self.registrations)
+        else:
+            rank = (1, self.registrations)
+        i = bisect.bisect_right(self.sortedRanks, rank)
+        self.sortedRanks.insert(i, rank)
+        self.sortedAgents.insert(i, agent)
+        self.agentRanks[agent] = rank
+        self.rankedAgents[rank] = agent
+        self.registeredAgents.append(agent)
+        self.broadcastReceivers = {}
+        if self.network is not None:
+            self.network.invalidateRoutes()
+
+        # agents are considered ready until they tell otherwise
+        self.notifyReady(agent)
+
+    def unregisterAgent(self, agent):
+        """
+        Remove an agent (given by name or instance) from the medium. Events
+        already scheduled for or by the agent are not cancelled.
+        """
+        name = agent if isinstance(agent, str) else agent.getName()
+        if name not in self.agents:
+            raise Exception('Agent "{0}" not registered'.format(name))
+        agent, priority = self.agents.pop(name)
+
+        self.notifyIdle(agent)
+        rank = self.agentRanks.pop(agent)
+        del self.rankedAgents[rank]
+        i = bisect.bisect_left(self.sortedRanks, rank)
+        del self.sortedRanks[i]
+        del self.sortedAgents[i]
+        self.registeredAgents.remove(agent)
+        self.broadcastReceivers = {}
+        if self.network is not None:
+            self.network.invalidateRoutes()
+
+        agent.unregisterMedium(self)
+
+    def notifyReady(self, agent):
+        """
+        Add an agent to the set of agents the medium is offered to
+        """
+        rank = self.agentRanks[agent]
+        i = bisect.bisect_left(self.readyRanks, rank)
+        if i == len(self.readyRanks) or self.readyRanks[i] != rank:
+            self.readyRanks.insert(i, rank)
 
-        self.sortedAgents = sortedAgents
+    def notifyIdle(self, agent):
+        """
+        Remove an agent from the set of agents the medium is offered to
+        """
+        rank = self.agentRanks[agent]
+        i = bisect.bisect_left(self.readyRanks, rank)
+        if i < len(self.readyRanks) and self.readyRanks[i] == rank:
+            del self.readyRanks[i]
 
     def arbitrate(self):
         """
@@ -645,10 +1954,11 @@ class Medium(object):
 
         # No arbitration if medium is blocked
         if not self.blocked:
-            # Offer the medium to each agent one by one
-            # (using the list sorted by descending priority)
-            for agent in self.sortedAgents:
-                if agent.offerMedium(self):
+            # Offer the medium to each ready agent one by one (in the order
+            # of sortedAgents; iterate over a copy as agents may turn idle)
+            rankedAgents = self.rankedAgents
+            for rank in self.readyRanks[:]:
+                if rankedAgents[rank].offerMedium(self):
                     # Stop once an agent has taken the medium
                     break
 
@@ -678,43 +1988,74 @@ class Medium(object):
             raise Exception('Cannot block medium: medium is already blocked')
         self.blocked = True
 
-        def unblock(medium):
-            medium.blocked = False
-            medium.arbitrate()
-
         # Use a callback to unblock the medium after <duration>
         self.scheduler.registerEventRel(Callback(
-                unblock, medium=self), duration, Medium.priorityUnblock)                
+                self.unblock), duration, Medium.priorityUnblock)
+
+    def unblock(self):
+        self.blocked = False
+        self.arbitrate()
 
     def isBlocked(self):
         return self.blocked
 
+    # changing a loss rate invalidates the cached loss probabilities
+
+    @property
+    def msg_loss_rate(self):
+        return self._msg_loss_rate
+
+    @msg_loss_rate.setter
+    def msg_loss_rate(self, rate):
+        self._msg_loss_rate = rate
+        self.lossPropCache = {}
+
+    @property
+    def bit_loss_rate(self):
+        return self._bit_loss_rate
+
+    @bit_loss_rate.setter
+    def bit_loss_rate(self, rate):
+        self._bit_loss_rate = rate
+        self.lossPropCache = {}
+
+    def computeMsgLossProp(self, length):
+        """
+        Return the loss probability of a message of <length> bytes. A message
+        is considered lost if at least one of its bits is corrupt (probability
+        affected by bit_loss_rate and the message's length) or if the whole
+        message is lost (probability affected by msg_loss_rate).
+        """
+        bit_corrupt_prop = 1. - (1. - self.bit_loss_rate)**(length * 8)
+        return bit_corrupt_prop + self.msg_loss_rate \
+                - (bit_corrupt_prop * self.msg_loss_rate)
+
     def getMsgLossProp(self, message):
         """
-        Return the loss probability of a message. A message is considered lost
-        if at least one of its bits is corrupt (probability affected by
-        bit_loss_rate and the message's length) or if the whole message is lost
-        (probability affected by msg_loss_rate).
+        Return the loss probability of a message (see computeMsgLossProp).
+        Loss probabilities are cached per message length.
         """
         if isinstance(message, ProtocolMessage):
-            bit_corrupt_prop = \
-                    1. - (1. - self.bit_loss_rate)**(message.getLength() * 8)
-            return bit_corrupt_prop + self.msg_loss_rate \
-                    - (bit_corrupt_prop * self.msg_loss_rate)
+            length = message.getLength()
+            try:
+                return self.lossPropCache[length]
+            except KeyError:
+                loss_prop = self.computeMsgLossProp(length)
+                self.lossPropCache[length] = loss_prop
+                return loss_prop
         else:
             return 0.
 
-    def log(self, text):
-        if self.logger:        
-            header = '[{0:>.3f}s]'.format(self.scheduler.getTime())
-            self.logger.log(header, '{0}: {1}'.format(self.getName(), text))
-
     def initiateMsgTX(self, message, sender, receiver=None):
 
         # make sender an agent object instance
         if isinstance(sender, str):
             sender, p_sender = self.agents[sender]
 
+        # ... and the receiver as well (None means broadcast)
+        if receiver and isinstance(receiver, str):
+            receiver, p_receiver = self.agents[receiver]
+
         if self.msg_slot_distance is not None:
             # determine time to next message slot
             frac, whole = math.modf(self.scheduler.getTime() / self.msg_slot_distance)
@@ -742,8 +2083,7 @@ class Medium(object):
 
             # ... and register a callback to send message at the next slot
             self.scheduler.registerEventRel(Callback(self.doMsgTX,
-                    message=message, sender=sender, receiver=receiver,
-                    duration=duration), timeToNextSlot)
+                    message, sender, receiver, duration), timeToNextSlot)
 
     def doMsgTX(self, message, sender, receiver, duration=None):
 
@@ -754,37 +2094,1487 @@ class Medium(object):
         else:
             loss_prop = None
 
-        sender.log(TextFormatter.makeBoldBlue(('--> sending message {0} ' +
-                '(p_loss = {1})').format(str(message), loss_prop)))
+        sender.log('--> sending message {0} (p_loss = {1})', message,
+                loss_prop, style=TextFormatter.makeBoldBlue)
+        if self.tracer is not None:
+            self.tracer.recordEvent(TraceRecorder.TX,
+                    self.scheduler.getTime(), sender.getName(), message)
 
         if not receiver:
             # this is a broadcast (let sender not receive its own message)
-            for agent, p_receiver in filter(
-                    lambda (a, p): a != sender, self.agents.values()):
-                self.dispatchMsg(message, sender, agent, loss_prop, duration)
+            self.dispatchMsg(message, sender,
+                    self.getBroadcastReceivers(sender), loss_prop, duration)
+        else:
+            self.dispatchMsg(message, sender, (receiver,), loss_prop, duration)
+
+    def getBroadcastReceivers(self, sender):
+        """
+        Return the agents receiving broadcasts from <sender>, i.e. all
+        registered agents but the sender (in the order of registration)
+        """
+        receivers = self.broadcastReceivers.get(sender)
+        if receivers is None:
+            receivers = [a for a in self.registeredAgents if a is not sender]
+            self.broadcastReceivers[sender] = receivers
+        return receivers
+
+    def dispatchMsg(self, message, sender, receivers, loss_prop, duration):
+
+        if loss_prop is None and duration is not None:
+            # no loss: all receivers get the message
+            received = receivers
         else:
-            # make receiver an object instance
-            if isinstance(receiver, str):
-                receiver, priority = self.agents[receiver]
-            self.dispatchMsg(message, sender, receiver, loss_prop, duration)
-
-    def dispatchMsg(self, message, sender, receiver, loss_prop, duration):
-
-        # handle random message loss according to loss_prop
-        if loss_prop is None or random.random() >= loss_prop:
-            # >>> message did not get lost >>>
-            if duration is None:
-                # immediate reception
+            received = []
+            for receiver in receivers:
+
+                # handle random message loss according to loss_prop
+                if loss_prop is None or self.random() >= loss_prop:
+                    # >>> message did not get lost >>>
+                    if duration is None:
+                        # immediate reception
+                        receiver.receive(message, sender)
+                    else:
+                        received.append(receiver)
+                elif self.logger is not None or self.tracer is not None:
+                    # >>> message got lost >>>
+                    self.lostMsg(message, sender, receiver)
+
+        # register one callback for reception after <duration>
+        # (delivering to all receivers that got the message)
+        if len(received) == 1:
+            self.scheduler.registerEventRel(Callback(received[0].receive,
+                    message, sender), duration, Medium.priorityReceive)
+        elif len(received) > 1:
+            self.scheduler.registerEventRel(Callback(self.deliverMsg,
+                    message, sender, received), duration, Medium.priorityReceive)
+
+    def lostMsg(self, message, sender, receiver):
+        self.log('Lost message {2} sent from {0} to {1}',
+                sender.getName(), receiver.getName(), message,
+                        style=TextFormatter.makeBoldRed)
+        if self.tracer is not None:
+            self.tracer.recordEvent(TraceRecorder.LOSS,
+                    self.scheduler.getTime(), receiver.getName(),
+                            message, True)
+
+    def deliverMsg(self, message, sender, receivers):
+        profiler = self.scheduler.profiler
+        if profiler is None:
+            for receiver in receivers:
                 receiver.receive(message, sender)
+        else:
+            # account the work of each receiver to the receiver
+            for receiver in receivers:
+                profiler.call(receiver.receive, message, sender)
+
+
+
+
+class Network(object):
+    """
+    A set of media connected by gateway agents (agents registered with more
+    than one medium). Routes minimise the number of hops. They are computed
+    by breadth-first search over media once per target medium, where a leaf
+    medium (attached to the network by a single gateway) is reached through
+    the medium of its gateway, so all leaf media behind the same medium
+    share one search. The next hop of each agent towards each destination
+    is looked up on first use. Everything is cached until agents or media
+    are added or removed.
+    """
+
+    def __init__(self, **params):
+
+        # the number of header bytes added to each routed message
+        self.header_length = params.get('header_length', 0)
+
+        self.media = []
+        for medium in params.get('media', []):
+            self.addMedium(medium)
+
+        self.invalidateRoutes()
+
+    def addMedium(self, medium):
+        if medium.network is not None:
+            raise Exception('Medium "{0}" already part of a network' \
+                    .format(medium.getName()))
+        medium.network = self
+        self.media.append(medium)
+        self.invalidateRoutes()
+
+    def removeMedium(self, medium):
+        if medium.network is not self:
+            raise Exception('Medium "{0}" not part of the network' \
+                    .format(medium.getName()))
+        medium.network = None
+        self.media.remove(medium)
+        self.invalidateRoutes()
+
+    def invalidateRoutes(self):
+        # the agents by name, the media of each agent (by name) and the
+        # links of each medium, i.e. the (gateway, other medium) pairs
+        # connecting it to other media of the network (built on demand)
+        self.agents = None
+        self.locations = None
+        self.links = None
+        # the cached routes by target medium and the cached
+        # (medium, hop) tuples by (agent, destination)
+        self.routes = {}
+        self.hops = {}
+
+    def updateTopology(self):
+
+        self.agents = {}
+        self.locations = {}
+        self.links = {}
+        for medium in self.media:
+            links = []
+            for agent in medium.registeredAgents:
+                name = agent.getName()
+                if self.agents.setdefault(name, agent) is not agent:
+                    raise Exception('Agent name "{0}" used more than once ' \
+                            'in the network'.format(name))
+                self.locations.setdefault(name, []).append(medium)
+                for other in agent.getMedia():
+                    if other is not medium and other.network is self:
+                        links.append((agent, other))
+            self.links[medium] = links
+
+    def getRoutes(self, target):
+        """
+        Return a dictionary mapping each medium that the medium <target>
+        can be reached from to a tuple (distance, gateway), where gateway
+        is the agent on that medium to pass messages to and distance the
+        number of media still to cross after that hop (the gateway is None
+        for the target itself)
+        """
+
+        routes = self.routes.get(target)
+        if routes is not None:
+            return routes
+
+        # breadth-first search starting at the target medium
+        routes = {target: (0, None)}
+        frontier = [target]
+        distance = 0
+        while frontier:
+            distance += 1
+            nextFrontier = []
+            for medium in frontier:
+                for gateway, other in self.links[medium]:
+                    if other not in routes:
+                        routes[other] = (distance, gateway)
+                        nextFrontier.append(other)
+            frontier = nextFrontier
+
+        self.routes[target] = routes
+        return routes
+
+    def getRoute(self, medium, target):
+        """
+        Return the tuple (distance, gateway) for passing messages from
+        <medium> towards the medium <target> (see getRoutes()), or None
+        if there is no route
+        """
+
+        if medium is target:
+            return 0, None
+
+        links = self.links[target]
+        if len(links) == 1 and len(self.links[links[0][1]]) > 1:
+            # a leaf medium is reached through the medium of its gateway
+            gateway, other = links[0]
+            if medium is other:
+                return 1, gateway
+            route = self.getRoutes(other).get(medium)
+            if route is None:
+                return None
+            return route[0] + 1, route[1]
+
+        return self.getRoutes(target).get(medium)
+
+    def route(self, agent, destination):
+        """
+        Return the tuple (medium, hop) telling <agent> on which of its media
+        and to which agent to pass a message for <destination>
+        """
+
+        key = (agent, destination)
+        hop = self.hops.get(key)
+        if hop is not None:
+            return hop
+
+        if self.agents is None:
+            self.updateTopology()
+        if destination not in self.agents:
+            raise Exception('Unknown destination "{0}"'.format(destination))
+
+        best = None
+        for medium in agent.getMedia():
+            for target in self.locations[destination]:
+                route = self.getRoute(medium, target)
+                if route is not None and (best is None or route[0] < best[0]):
+                    best = route[0], medium, route[1]
+        if best is None:
+            raise Exception('No route from "{0}" to "{1}"'.format(
+                    agent.getName(), destination))
+
+        distance, medium, gateway = best
+        if gateway is None:
+            # the destination is on the same medium
+            gateway = self.agents[destination]
+        hop = (medium, gateway)
+        self.hops[key] = hop
+        return hop
+
+
+class ExponentialTimeouts(object):
+    """
+    Retransmission timeouts doubling with each retransmission, i.e. the
+    timeout after the i-th transmission is <initial> * 2**i. At most
+    <retransmissions> retransmissions are triggered (None means no limit).
+    Unlike a lambda, instances can be handed to worker processes.
+    """
+
+    def __init__(self, initial=1., retransmissions=None):
+        self.initial = initial
+        self.retransmissions = retransmissions
+
+    def __call__(self, index):
+        if self.retransmissions is not None and index >= self.retransmissions:
+            return None
+        return self.initial * 2**index
+
+    def getKey(self):
+        return ['ExponentialTimeouts', self.initial, self.retransmissions]
+
+    def __repr__(self):
+        return 'ExponentialTimeouts({0!r}, {1!r})'.format(self.initial, self.retransmissions)
+
+
+class LinearTimeouts(object):
+    """
+    Retransmission timeouts growing linearly with each retransmission, i.e.
+    the timeout after the i-th transmission is <initial> * (i + 1). At most
+    <retransmissions> retransmissions are triggered (None means no limit).
+    """
+
+    def __init__(self, initial=1., retransmissions=None):
+        self.initial = initial
+        self.retransmissions = retransmissions
+
+    def __call__(self, index):
+        if self.retransmissions is not None and index >= self.retransmissions:
+            return None
+        return self.initial * (index + 1)
+
+    def getKey(self):
+        return ['LinearTimeouts', self.initial, self.retransmissions]
+
+    def __repr__(self):
+        return 'LinearTimeouts({0!r}, {1!r})'.format(self.initial, self.retransmissions)
+
+
+# The outcome of a single replication of a scenario
+ReplicationResult = collections.namedtuple('ReplicationResult',
+        ['seed', 'completionTime', 'txBytes', 'retransmissions', 'events'])
+
+
+class HandshakeScenario(object):
+    """
+    This is a scenario factory for a flight exchange between a
+    GenericClientAgent and a GenericServerAgent sharing one Medium. Medium
+    parameters are passed as keyword arguments (a 'logger' is used by the
+    agents as well). Scenarios are sent to worker processes and must
+    therefore be picklable (see ExponentialTimeouts and LinearTimeouts for
+    picklable timeout policies). <limits> is a dictionary
+    of limits passed to Scheduler.run() (e.g. {'until': 3600.}) to cap the
+    cost of pathological replications; replications stopped by a limit
+    before the handshake completed count as incomplete.
+    """
+
+    def __init__(self, flights, timeouts=None, limits=None, **mediumParams):
+        for name in ['seed', 'rng']:
+            if name in mediumParams:
+                raise Exception('The medium parameter "{0}" cannot be used '
+                        'with scenarios: each replication is seeded by '
+                        'run(seed)'.format(name))
+        self.flights = flights
+        self.timeouts = timeouts
+        self.limits = limits
+        self.mediumParams = mediumParams
+
+    def getKey(self):
+        """
+        Return a description of the scenario (made of JSON types) that
+        identifies its results. Timeout policies need to provide getKey()
+        as well (functions cannot be told apart). Loggers and tracers
+        don't affect results and are left out.
+        """
+        if self.timeouts is not None and not hasattr(self.timeouts, 'getKey'):
+            raise Exception('The timeout policy does not provide a key')
+        key = {
+            'flights': [[[msg.getName(), msg.getLength()] for msg in flight]
+                    for flight in self.flights],
+            'timeouts': self.timeouts.getKey() if self.timeouts else None,
+            'medium': dict([(name, value) for name, value in
+                    self.mediumParams.items() if name not in ['logger', 'tracer']]),
+        }
+        if self.limits:
+            # (left out otherwise to keep the keys of existing results)
+            key['limits'] = self.limits
+        return key
+
+    def buildModelMedium(self):
+        """
+        Create a medium on its own (with a fixed seed to leave the global
+        random stream alone) for models of the scenario like
+        HandshakeEstimator and LockstepHandshakeSimulator, which support
+        neither message slotting nor run limits
+        """
+        if self.mediumParams.get('msg_slot_distance', None) is not None:
+            raise Exception('Message slotting is not supported')
+        if self.limits:
+            raise Exception('Run limits are not supported')
+        mediumParams = dict(self.mediumParams)
+        mediumParams['seed'] = 0
+        return Medium(Scheduler(), **mediumParams)
+
+    def build(self, scheduler, seed=None):
+        """
+        Create the medium and the agents. Returns (medium, client, server).
+        """
+        medium = Medium(scheduler, seed=seed, **self.mediumParams)
+        # (agents log to the medium's logger)
+        logger = self.mediumParams.get('logger', None)
+        server = GenericServerAgent('server', scheduler, self.flights,
+                timeouts=self.timeouts, logger=logger)
+        client = GenericClientAgent('client', scheduler, self.flights,
+                timeouts=self.timeouts, logger=logger)
+        # the client is offered the medium first (as assumed by
+        # HandshakeEstimator and LockstepHandshakeSimulator)
+        medium.registerAgent(client)
+        medium.registerAgent(server)
+        return medium, client, server
+
+    def run(self, seed):
+        scheduler = Scheduler()
+        medium, client, server = self.build(scheduler, seed)
+        client.trigger()
+        scheduler.run(**(self.limits or {}))
+
+        # the handshake is complete once the last flight has been received
+        completionTime = None
+        for agent in [client, server]:
+            if agent.done:
+                completionTime = agent.doneAtTime
+
+        agents = [client, server]
+        return ReplicationResult(
+                seed=seed,
+                completionTime=completionTime,
+                txBytes=sum([agent.getTxCount() for agent in agents]),
+                retransmissions=sum([max(n - 1, 0) for agent in agents
+                        for n in agent.transmissions]),
+                events=scheduler.getEventCount())
+
+
+def runReplication(task):
+    """
+    Run a single replication given as a tuple (scenario, seed)
+    (this is the function executed by worker processes)
+    """
+    scenario, seed = task
+    return scenario.run(seed)
+
+
+def runReplications(scenario, replications, seed=0, processes=None, first=0,
+        pool=None):
+    """
+    Run <replications> independent replications of <scenario> (an object
+    providing run(seed) and returning a ReplicationResult) on a pool of
+    <processes> worker processes (None means one per CPU, 1 means no pool
+    at all). Replication #i runs with the seed deriveSeed(<seed>, i), such
+    that the results (returned in the order of replications) do not depend
+    on the number of worker processes. A single replication can be replayed
+    with scenario.run(result.seed). <first> is the number of the first
+    replication (to continue a previous call). An existing <pool> (with
+    <processes> workers) is used instead of creating a new one, which saves
+    starting the workers for each call.
+    """
+
+    tasks = [(scenario, deriveSeed(seed, first + i))
+            for i in range(replications)]
+
+    if processes == 1 and pool is None:
+        return [runReplication(task) for task in tasks]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    # hand out replications in chunks to keep the IPC overhead small
+    chunksize = max(1, replications // (4 * processes))
+    if pool is not None:
+        return pool.map(runReplication, tasks, chunksize)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(runReplication, tasks, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# the snapshot and branch function of the current forkSimulation() call
+# (inherited by forked worker processes instead of being sent to them)
+branchSnapshot = None
+branchFunction = None
+
+
+def initBranches(snapshot, function):
+    global branchSnapshot, branchFunction
+    branchSnapshot = snapshot
+    branchFunction = function
+
+
+def runBranch(seed):
+    """
+    Continue a copy of the current snapshot with the random streams seeded
+    from <seed> (this is the function executed by worker processes)
+    """
+    simulation, media = cPickle.loads(branchSnapshot)
+    random.seed(seed)
+    for medium in media:
+        medium.reseed(seed)
+    return branchFunction(simulation)
+
+
+def forkSimulation(simulation, media, function, branches, seed=0,
+        processes=None, first=0):
+    """
+    Continue <branches> independent copies of a running <simulation> (any
+    picklable object referring to the scheduler, media and agents, see
+    saveCheckpoint) such that a common prefix is simulated only once. The
+    simulation is pickled once and each branch loads its own copy, reseeds
+    the copies of <media> (the media within <simulation> to draw different
+    losses in each branch) and the module-global random generator with
+    deriveSeed(<seed>, i) for branch #i, and returns function(copy). The
+    function typically adjusts the copy (e.g. sets a loss rate or triggers
+    an agent), runs its scheduler and extracts the results. Branches run on
+    a pool of <processes> forked worker processes (None means one per CPU,
+    1 means no pool at all) which inherit the snapshot and the function,
+    so the function need not be picklable. The results are returned in the
+    order of branches; <first> is the number of the first branch.
+    """
+
+    snapshot = dumpSimulation((simulation, media))
+    seeds = [deriveSeed(seed, first + i) for i in range(branches)]
+
+    if processes == 1:
+        # don't leave the caller with the state of the last branch
+        state = random.getstate()
+        initBranches(snapshot, function)
+        try:
+            return [runBranch(branchSeed) for branchSeed in seeds]
+        finally:
+            initBranches(None, None)
+            random.setstate(state)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    pool = multiprocessing.Pool(processes, initBranches, (snapshot, function))
+    try:
+        chunksize = max(1, branches // (4 * processes))
+        return pool.map(runBranch, seeds, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class Distribution(object):
+    """
+    A discrete probability distribution given as a dictionary mapping values
+    to probabilities. The probabilities may sum up to less than one, the
+    remainder being the probability of no value at all (e.g. of incomplete
+    handshakes). Statistics are conditional on there being a value.
+    """
+
+    def __init__(self, probabilities):
+        self.probabilities = probabilities
+        self.values = sorted(probabilities.keys())
+
+    def items(self):
+        return [(value, self.probabilities[value]) for value in self.values]
+
+    def getTotal(self):
+        return math.fsum(self.probabilities.values())
+
+    def getMean(self):
+        return math.fsum([v * p for v, p in self.items()]) / self.getTotal()
+
+    def getVariance(self):
+        mean = self.getMean()
+        return math.fsum([(v - mean)**2 * p for v, p in self.items()]) \
+                / self.getTotal()
+
+    def getStd(self):
+        return math.sqrt(self.getVariance())
+
+    def getQuantile(self, q):
+        """
+        Return the smallest value with a cumulative probability of at least
+        <q> (relative to the total probability)
+        """
+        threshold = q * self.getTotal()
+        cumulated = 0.
+        for value, p in self.items():
+            cumulated += p
+            if cumulated >= threshold:
+                return value
+        return self.values[-1] if self.values else None
+
+    def getMedian(self):
+        return self.getQuantile(0.5)
+
+
+class HandshakeEstimator(object):
+    """
+    This class computes the distribution of the completion time of a
+    HandshakeScenario without simulation. Flights are considered pairwise
+    in phases: the sender (re)transmits a flight following the timeouts
+    until the receiver has received each message at least once; the
+    receiver then starts the next flight. Within a phase, the completion
+    time distribution follows from the per-message loss probabilities in
+    closed form (the flight is complete after j transmissions with
+    probability prod_i (1 - p_i**j)). The last two flights are modelled as
+    a Markov chain over the sets of messages received by either side.
+
+    The estimate is exact up to the following approximations: the medium
+    serves each agent's messages in FIFO order and the client wins
+    arbitration; retransmissions of flights that have already been received
+    (which only occupy the medium) are ignored; message slotting
+    (msg_slot_distance) is not supported. Probabilities below <epsilon> are
+    dropped and no flight is transmitted more than <max_attempts> times.
+
+    Only congestion-free scenarios are supported, i.e. timeouts long enough
+    for each flight to be acknowledged before it is retransmitted (see
+    isCongestionFree). Otherwise, needless retransmissions queue up on the
+    medium and delay the replies, which the estimate does not model: it
+    would be far too optimistic (e.g. about a third of the simulated mean
+    for exponential timeouts starting at 1s on a 2400 bit/s link) and
+    estimate() raises an exception instead. Such scenarios, like the
+    loss-rate sweep of sim-plot-dtls.py, need to be simulated.
+    """
+
+    def __init__(self, scenario, **params):
+
+        # (to compute durations and loss probabilities)
+        medium = scenario.buildModelMedium()
+
+        self.flights = scenario.flights
+        self.timeouts = scenario.timeouts
+        self.epsilon = params.get('epsilon', 1e-12)
+        self.max_attempts = params.get('max_attempts', 64)
+        gap = float(medium.inter_msg_time)
+
+        # the loss probability of each message and the times relative to
+        # the start of a flight transmission at which each message is
+        # received and at which the medium is released after each message
+        self.losses = []
+        self.receptions = []
+        self.releases = []
+        for flight in self.flights:
+            losses, receptions, releases = [], [], []
+            offset = 0.
+            for msg in flight:
+                if medium.data_rate is None:
+                    duration = 0.
+                else:
+                    duration = float(msg.getLength()) / float(medium.data_rate)
+                losses.append(medium.computeMsgLossProp(msg.getLength()))
+                receptions.append(offset + duration)
+                offset += duration + gap
+                releases.append(offset)
+            self.losses.append(losses)
+            self.receptions.append(receptions)
+            self.releases.append(releases)
+
+    def getTimeout(self, index):
+        if self.timeouts:
+            return self.timeouts(index)
+        return None
+
+    def isCongestionFree(self):
+        """
+        Return True if, without losses, each flight is acknowledged before
+        its retransmission timeout expires (the estimate is only accurate
+        if this holds)
+        """
+        for flight in range(len(self.flights) - 1):
+            duration = self.releases[flight][-1] if self.flights[flight] else 0.
+            replies = self.receptions[flight + 1]
+            if not replies:
+                continue
+            if (flight + 2) == len(self.flights):
+                # the second-to-last flight is acknowledged by the last
+                # flight as a whole
+                delay = duration + replies[-1]
+            else:
+                delay = duration + replies[0]
+            for k in range(self.max_attempts):
+                timeout = self.getTimeout(k)
+                if timeout is None:
+                    break
+                if timeout <= delay:
+                    return False
+        return True
+
+    def getAttempts(self, flight):
+        """
+        Return the start times of the transmissions of <flight> relative to
+        the first one (a transmission starts when its timeout expires or
+        once the previous transmission has left the medium, whichever is
+        later)
+        """
+        duration = self.releases[flight][-1] if self.flights[flight] else 0.
+        attempts = [0.]
+        timer = 0.
+        while len(attempts) < self.max_attempts:
+            timeout = self.getTimeout(len(attempts) - 1)
+            if timeout is None:
+                break
+            timer += timeout
+            attempts.append(max(timer, attempts[-1] + duration))
+        return attempts
+
+    def getPhaseOutcomes(self, flight):
+        """
+        Return the outcomes of a phase in which <flight> is transmitted
+        until received completely as a list of tuples (probability, delay,
+        backlog, addBacklog): the next flight starts <delay> after the
+        first transmission of <flight> (plus the receiver's backlog if
+        addBacklog is True), and the sender is left with <backlog> seconds
+        of pending transmissions
+        """
+
+        losses = self.losses[flight]
+        releases = self.releases[flight]
+        duration = releases[-1]
+        senderFirst = (flight % 2) == 0
+
+        outcomes = []
+        for j, start in enumerate(self.getAttempts(flight)):
+            # the flight is completed by message m of the j-th transmission
+            # if m has been lost j times before and is received now, all
+            # messages before m are received by now and all messages after
+            # m have been received before
+            for m in range(len(losses)):
+                prob = losses[m]**j * (1. - losses[m])
+                for i in range(len(losses)):
+                    if i < m:
+                        prob *= 1. - losses[i]**(j + 1)
+                    elif i > m:
+                        prob *= 1. - losses[i]**j
+                if prob < self.epsilon:
+                    continue
+                if senderFirst:
+                    # the sender finishes its transmission first
+                    outcomes.append((prob, start + duration, 0., j == 0))
+                else:
+                    outcomes.append((prob, start + releases[m],
+                            duration - releases[m], False))
+        return outcomes
+
+    def getFinalOutcomes(self):
+        """
+        Return the outcomes of the final phase (the last two flights) as a
+        list of tuples (probability, delay, addBacklog), where <delay> is
+        the completion time relative to the first transmission of the
+        second-to-last flight
+        """
+
+        flight = len(self.flights) - 2
+        losses = self.losses[flight]
+        releases = self.releases[flight]
+        lastLosses = self.losses[flight + 1]
+        lastReceptions = self.receptions[flight + 1]
+        senderFirst = (flight % 2) == 0
+        complete = (1 << len(losses)) - 1
+        lastComplete = (1 << len(lastLosses)) - 1
+
+        # the probability of each subset (as a bit mask) of the last
+        # flight's messages to be received in one transmission
+        lastSubsets = []
+        for subset in range(lastComplete + 1):
+            prob = 1.
+            for i, p in enumerate(lastLosses):
+                prob *= (1. - p) if subset & (1 << i) else p
+            lastSubsets.append((subset, prob))
+
+        # the states (covered, received, sent): the messages of the
+        # second-to-last flight received by the other side since it last
+        # sent the last flight, the messages of the last flight received
+        # and whether the last flight has been sent at all
+        states = {(0, 0, False): 1.}
+        outcomes = []
+        for k, start in enumerate(self.getAttempts(flight)):
+
+            for m, p in enumerate(losses):
+                nextStates = collections.defaultdict(float)
+                for (covered, received, sent), prob in states.iteritems():
+                    # message m is lost
+                    nextStates[(covered, received, sent)] += prob * p
+                    # message m is received
+                    covered |= 1 << m
+                    if covered != complete:
+                        nextStates[(covered, received, sent)] += prob * (1. - p)
+                        continue
+                    # the second-to-last flight has been received completely:
+                    # the other side (re)transmits the last flight
+                    if senderFirst:
+                        lastStart = start + releases[-1]
+                    else:
+                        lastStart = start + releases[m]
+                    for subset, q in lastSubsets:
+                        q *= prob * (1. - p)
+                        if q < self.epsilon:
+                            continue
+                        if received | subset == lastComplete:
+                            # the reception of the last missing message
+                            # completes the handshake
+                            missing = lastComplete & ~received
+                            last = max([i for i in range(len(lastLosses))
+                                    if missing & (1 << i)])
+                            outcomes.append((q, lastStart + lastReceptions[last],
+                                    senderFirst and not sent and k == 0))
+                        else:
+                            nextStates[(0, received | subset, True)] += q
+                states = dict([(s, prob) for s, prob in nextStates.iteritems()
+                        if prob >= self.epsilon])
+
+            if not states:
+                break
+
+        return outcomes
+
+    def estimate(self):
+        """
+        Return the distribution of the completion time as a Distribution
+        (missing probability means the handshake does not complete)
+        """
+
+        if not self.flights:
+            return Distribution({})
+
+        if not self.isCongestionFree():
+            raise Exception('Timeouts expire before flights are acknowledged: '
+                    'congested scenarios are not supported')
+
+        if len(self.flights) == 1:
+            # a single flight is transmitted once
+            prob = 1.
+            for p in self.losses[0]:
+                prob *= 1. - p
+            return Distribution({self.receptions[0][-1]: prob})
+
+        # the joint distribution of the start time of the current flight
+        # and the backlog of the agent receiving it
+        starts = {(0., 0.): 1.}
+        for flight in range(len(self.flights) - 2):
+            outcomes = self.getPhaseOutcomes(flight)
+            nextStarts = collections.defaultdict(float)
+            for (start, backlog), prob in starts.iteritems():
+                for q, delay, nextBacklog, addBacklog in outcomes:
+                    if addBacklog:
+                        delay += backlog
+                    nextStarts[(round(start + delay, 9), nextBacklog)] += prob * q
+            starts = dict([(s, prob) for s, prob in nextStarts.iteritems()
+                    if prob >= self.epsilon])
+
+        outcomes = self.getFinalOutcomes()
+        probabilities = collections.defaultdict(float)
+        for (start, backlog), prob in starts.iteritems():
+            for q, delay, addBacklog in outcomes:
+                if addBacklog:
+                    delay += backlog
+                probabilities[round(start + delay, 9)] += prob * q
+
+        return Distribution(dict(probabilities))
+
+
+class LockstepHandshakeSimulator(object):
+    """
+    This class simulates many replications of a HandshakeScenario at once.
+    The state of all replications (current flights, reception bitmaps,
+    retransmission counters, TX queues, timers and clocks) is kept in NumPy
+    arrays and each step advances every replication by one event, such that
+    the interpreter overhead is shared by all replications.
+
+    Replications behave like the event-driven ones, but use a different
+    random stream (results agree in distribution, not one by one). Only the
+    subset of features used by HandshakeScenario is supported: one medium
+    without message slotting, flights of at most 62 messages and at most
+    <max_timeouts> timer-triggered transmissions per flight. Events at the
+    very same time are handled in a fixed order (receptions, timeouts, then
+    the medium becoming free).
+    """
+
+    def __init__(self, scenario, **params):
+
+        if numpy is None:
+            raise Exception('Lockstep simulation requires NumPy')
+        # (to compute durations and loss probabilities)
+        medium = scenario.buildModelMedium()
+
+        flights = scenario.flights
+        if max([len(flight) for flight in flights] + [0]) > 62:
+            raise Exception('Flights of more than 62 messages are not supported')
+        self.nFlights = len(flights)
+        self.gap = float(medium.inter_msg_time)
+
+        # the messages of all flights (by global index): their flight,
+        # length, duration and loss probability
+        messages = [msg for flight in flights for msg in flight]
+        self.msgLength = numpy.array([msg.getLength() for msg in messages],
+                dtype=numpy.int64)
+        if medium.data_rate is None:
+            self.msgDuration = numpy.zeros(len(messages))
+        else:
+            self.msgDuration = self.msgLength / float(medium.data_rate)
+        self.msgLoss = numpy.array([medium.computeMsgLossProp(msg.getLength())
+                for msg in messages])
+
+        # the global index of the first message, the number of messages
+        # and the bitmap of a complete reception of each flight
+        sizes = [len(flight) for flight in flights]
+        self.flightStart = numpy.cumsum([0] + sizes[:-1]).astype(numpy.int64)
+        self.flightSize = numpy.array(sizes, dtype=numpy.int64)
+        self.flightComplete = (numpy.int64(1) << self.flightSize) - 1
+
+        # the index of each message within the flight expected by the
+        # receiver (messages are identified by name, -1 means unexpected)
+        self.lookup = -numpy.ones((self.nFlights, max(len(messages), 1)),
+                dtype=numpy.int64)
+        for expected, flight in enumerate(flights):
+            indices = {}
+            for i, msg in enumerate(flight):
+                indices.setdefault(msg.getName(), i)
+            for g, msg in enumerate(messages):
+                self.lookup[expected, g] = indices.get(msg.getName(), -1)
+
+        # the timeout after the k-th transmission of a flight (inf: none)
+        self.timeouts = numpy.array([scenario.timeouts(k)
+                if scenario.timeouts else None
+                        for k in range(params.get('max_timeouts', 256))],
+                                dtype=float)
+        self.timeouts[numpy.isnan(self.timeouts)] = numpy.inf
+        # no timeouts after the first missing one
+        self.timeouts[numpy.cumsum(numpy.isinf(self.timeouts)) > 0] = numpy.inf
+        self.timeouts = numpy.append(self.timeouts, numpy.inf)
+
+    def reset(self, replications, seed):
+
+        n = replications
+        self.rng = numpy.random.RandomState(seed)
+        self.time = numpy.zeros(n)
+        self.events = numpy.zeros(n, dtype=numpy.int64)
+        self.txBytes = numpy.zeros(n, dtype=numpy.int64)
+
+        # the TX queues of client (0) and server (1): ring buffers of the
+        # flights queued for transmission and the next message of the first
+        self.queueSize = 16
+        self.qFlight = numpy.zeros((n, 2, self.queueSize), dtype=numpy.int64)
+        self.qHead = numpy.zeros((n, 2), dtype=numpy.int64)
+        self.qLen = numpy.zeros((n, 2), dtype=numpy.int64)
+        self.qMsg = numpy.zeros((n, 2), dtype=numpy.int64)
+
+        # the medium: the message (global index) on the medium, its sender,
+        # when it is received (inf if lost) and when the medium is free
+        self.blocked = numpy.zeros(n, dtype=bool)
+        self.txMsg = numpy.zeros(n, dtype=numpy.int64)
+        self.txAgent = numpy.zeros(n, dtype=numpy.int64)
+        self.recvTime = numpy.full(n, numpy.inf)
+        self.unblockTime = numpy.full(n, numpy.inf)
+
+        # the retransmission timer of each agent (at most one is pending)
+        self.timerTime = numpy.full((n, 2), numpy.inf)
+        self.timerFlight = numpy.zeros((n, 2), dtype=numpy.int64)
+
+        # the protocol state: the current flight of each agent, the number
+        # of transmissions and the bitmap of received messages of each
+        # flight, the messages of the second-to-last flight received since
+        # the last flight has last been transmitted and completion
+        self.currentFlight = numpy.zeros((n, 2), dtype=numpy.int64)
+        self.transmissions = numpy.zeros((n, self.nFlights), dtype=numpy.int64)
+        self.received = numpy.zeros((n, self.nFlights), dtype=numpy.int64)
+        self.stlReceived = numpy.zeros(n, dtype=numpy.int64)
+        self.done = numpy.zeros(n, dtype=bool)
+        self.doneAt = numpy.zeros(n)
+
+    def growQueues(self):
+        # unroll the ring buffers and double their size
+        order = (self.qHead[:, :, None] + numpy.arange(self.queueSize)) \
+                % self.queueSize
+        unrolled = numpy.take_along_axis(self.qFlight, order, axis=2)
+        self.qFlight = numpy.concatenate(
+                [unrolled, numpy.zeros_like(unrolled)], axis=2)
+        self.qHead[:] = 0
+        self.queueSize *= 2
+
+    def isAcknowledged(self, idx, flight):
+        received = self.received[idx, flight + 1]
+        if self.nFlights > 1:
+            # the second-to-last flight has to be treated differently
+            return numpy.where(flight + 2 == self.nFlights,
+                    received == self.flightComplete[flight + 1], received != 0)
+        return received != 0
+
+    def transmitFlight(self, idx, agent, flight):
+
+        # queue the flight for transmission
+        if (self.qLen[idx, agent] == self.queueSize).any():
+            self.growQueues()
+        pos = (self.qHead[idx, agent] + self.qLen[idx, agent]) % self.queueSize
+        self.qFlight[idx, agent, pos] = flight
+        self.qLen[idx, agent] += 1
+
+        # don't trigger the retransmission of the last flight using timeout
+        timeout = self.timeouts[numpy.minimum(self.transmissions[idx, flight],
+                len(self.timeouts) - 1)]
+        sel = (flight + 1 < self.nFlights) & numpy.isfinite(timeout)
+        self.timerTime[idx[sel], agent[sel]] = self.time[idx[sel]] + timeout[sel]
+        self.timerFlight[idx[sel], agent[sel]] = flight[sel]
+
+        self.transmissions[idx, flight] += 1
+
+        # clear reception tracking of second-to-last flight
+        if self.nFlights > 1:
+            self.stlReceived[idx[flight + 1 == self.nFlights]] = 0
+
+        # move on to the next flight if this is the current flight
+        sel = (flight == self.currentFlight[idx, agent]) & \
+                (flight + 1 < self.nFlights)
+        self.currentFlight[idx[sel], agent[sel]] += 1
+
+        self.arbitrate(idx)
+
+    def arbitrate(self, idx):
+
+        # offer the medium to the client first
+        idx = idx[~self.blocked[idx]]
+        pending = self.qLen[idx] > 0
+        sel = pending[:, 0] | pending[:, 1]
+        idx = idx[sel]
+        agent = numpy.where(pending[sel, 0], 0, 1)
+
+        # retrieve the next message from the agent's TX queue
+        head = self.qHead[idx, agent]
+        flight = self.qFlight[idx, agent, head]
+        msg = self.flightStart[flight] + self.qMsg[idx, agent]
+        self.qMsg[idx, agent] += 1
+        sel = self.qMsg[idx, agent] == self.flightSize[flight]
+        self.qMsg[idx[sel], agent[sel]] = 0
+        self.qHead[idx[sel], agent[sel]] = (head[sel] + 1) % self.queueSize
+        self.qLen[idx[sel], agent[sel]] -= 1
+
+        # transmit it (one event to start the transmission, one to free
+        # the medium and one for the reception unless the message is lost)
+        self.txBytes[idx] += self.msgLength[msg]
+        self.events[idx] += 2
+        lost = self.rng.random_sample(len(idx)) < self.msgLoss[msg]
+        duration = self.msgDuration[msg]
+        self.txMsg[idx] = msg
+        self.txAgent[idx] = agent
+        self.recvTime[idx] = numpy.where(lost, numpy.inf,
+                self.time[idx] + duration)
+        self.unblockTime[idx] = self.time[idx] + duration + self.gap
+        self.blocked[idx] = True
+
+    def unblock(self, idx):
+        self.blocked[idx] = False
+        self.unblockTime[idx] = numpy.inf
+        self.arbitrate(idx)
+
+    def expireTimer(self, idx):
+        self.events[idx] += 1
+        agent = numpy.argmin(self.timerTime[idx], axis=1)
+        flight = self.timerFlight[idx, agent]
+        self.timerTime[idx, agent] = numpy.inf
+
+        # retransmit unless acknowledged
+        sel = ~self.isAcknowledged(idx, flight)
+        self.transmitFlight(idx[sel], agent[sel], flight[sel])
+
+    def receive(self, idx):
+
+        self.events[idx] += 1
+        self.recvTime[idx] = numpy.inf
+        agent = 1 - self.txAgent[idx]
+        current = self.currentFlight[idx, agent]
+        # clients transmit even flights, servers odd ones
+        isTX = (current % 2) == agent
+
+        # look up the message in the expected flight and ignore it if
+        # it is unexpected
+        expected = current - ((current + 1 == self.nFlights) & isTX)
+        msgIndex = self.lookup[expected, self.txMsg[idx]]
+        sel = msgIndex >= 0
+        idx, agent, current, isTX, expected, msgIndex = idx[sel], agent[sel], \
+                current[sel], isTX[sel], expected[sel], msgIndex[sel]
+
+        # remember that the message has been received
+        bit = numpy.int64(1) << msgIndex
+        self.received[idx, expected] |= bit
+        if self.nFlights > 1:
+            sel = expected + 2 == self.nFlights
+            self.stlReceived[idx[sel]] |= bit[sel]
+
+        # the reception might acknowledge our previous flight
+        sel = expected > 0
+        sel[sel] = self.isAcknowledged(idx[sel], expected[sel] - 1)
+        sel &= self.timerFlight[idx, agent] == expected - 1
+        self.timerTime[idx[sel], agent[sel]] = numpy.inf
+
+        complete = self.received[idx, current] == self.flightComplete[current]
+        notLast = current + 1 < self.nFlights
+
+        # move on to the next flight once the current one has been
+        # received completely and transmit it
+        sel = notLast & complete
+        self.currentFlight[idx[sel], agent[sel]] += 1
+        nextFlight = current + 1
+
+        # retransmit the last flight once the second-to-last flight has
+        # been re-received completely
+        if self.nFlights > 1:
+            retransmit = ~notLast & isTX & (self.stlReceived[idx] ==
+                    self.flightComplete[self.nFlights - 2])
+        else:
+            retransmit = numpy.zeros(len(idx), dtype=bool)
+
+        # the communication sequence is complete
+        finish = ~notLast & ~isTX & complete & ~self.done[idx]
+        self.done[idx[finish]] = True
+        self.doneAt[idx[finish]] = self.time[idx[finish]]
+
+        sel = (notLast & complete) | retransmit
+        self.transmitFlight(idx[sel], agent[sel],
+                numpy.where(retransmit, current, nextFlight)[sel])
+
+    def run(self, replications, seed=0):
+        """
+        Run <replications> replications and return a list of
+        ReplicationResult (without seeds, as replications cannot be
+        replayed individually)
+        """
+
+        self.reset(replications, seed)
+        if self.nFlights > 0:
+            # the client triggers the communication sequence
+            idx = numpy.arange(replications)
+            self.transmitFlight(idx, numpy.zeros_like(idx), numpy.zeros_like(idx))
+
+        while True:
+            timerTime = self.timerTime.min(axis=1)
+            nextTime = numpy.minimum(numpy.minimum(self.recvTime, timerTime),
+                    self.unblockTime)
+            idx = numpy.nonzero(nextTime < numpy.inf)[0]
+            if len(idx) == 0:
+                break
+            self.time[idx] = nextTime[idx]
+
+            sel = self.recvTime[idx] == nextTime[idx]
+            receptions, idx = idx[sel], idx[~sel]
+            sel = timerTime[idx] == nextTime[idx]
+            timeouts, unblocks = idx[sel], idx[~sel]
+
+            self.receive(receptions)
+            self.expireTimer(timeouts)
+            self.unblock(unblocks)
+
+        retransmissions = numpy.maximum(self.transmissions - 1, 0).sum(axis=1)
+        return [ReplicationResult(seed=None,
+                completionTime=float(self.doneAt[i]) if self.done[i] else None,
+                txBytes=int(self.txBytes[i]),
+                retransmissions=int(retransmissions[i]),
+                events=int(self.events[i])) for i in range(replications)]
+
+
+def normalQuantile(p):
+    """
+    Return the <p>-quantile of the standard normal distribution
+    """
+    low, high = -40., 40.
+    for i in range(100):
+        mid = (low + high) / 2.
+        if 0.5 * (1. + math.erf(mid / math.sqrt(2.))) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2.
+
+
+class RunningStats(object):
+    """
+    This class keeps the count, mean and variance of a stream of values
+    without storing the values (Welford's algorithm)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def getCount(self):
+        return self.count
+
+    def getMean(self):
+        return self.mean if self.count > 0 else None
+
+    def getVariance(self):
+        # the sample variance
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.
+
+    def getStd(self):
+        return math.sqrt(self.getVariance())
+
+    def getHalfWidth(self, confidence=0.95):
+        """
+        Return the half-width of the confidence interval of the mean
+        """
+        if self.count < 2:
+            return float('inf')
+        z = normalQuantile(0.5 + confidence / 2.)
+        return z * self.getStd() / math.sqrt(self.count)
+
+
+class P2Quantile(object):
+    """
+    This class estimates the <q>-quantile of a stream of values without
+    storing the values, using five markers whose heights are adjusted with
+    piecewise-parabolic interpolation (the P-square algorithm by Jain and
+    Chlamtac, 1985)
+    """
+
+    def __init__(self, q):
+        self.q = q
+        self.count = 0
+        # the marker heights, actual and desired positions (the first five
+        # values are kept as they are until the markers are set up)
+        self.heights = []
+        self.positions = [1., 2., 3., 4., 5.]
+        self.desired = [1., 1. + 2. * q, 1. + 4. * q, 3. + 2. * q, 5.]
+        self.increments = [0., q / 2., q, (1. + q) / 2., 1.]
+
+    def add(self, value):
+
+        self.count += 1
+        heights = self.heights
+        if self.count <= 5:
+            bisect.insort(heights, value)
+            return
+
+        # find the cell the value falls into and adjust extreme markers
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = bisect.bisect_right(heights, value) - 1
+
+        positions = self.positions
+        for i in range(k + 1, 5):
+            positions[i] += 1.
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # move the middle markers towards their desired positions
+        for i in range(1, 4):
+            d = self.desired[i] - positions[i]
+            if (d >= 1. and positions[i + 1] - positions[i] > 1.) or \
+                    (d <= -1. and positions[i - 1] - positions[i] < -1.):
+                d = 1. if d > 0 else -1.
+                height = self.parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    j = i + int(d)
+                    height = heights[i] + d * (heights[j] - heights[i]) \
+                            / (positions[j] - positions[i])
+                heights[i] = height
+                positions[i] += d
+
+    def parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def getCount(self):
+        return self.count
+
+    def getValue(self):
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            return self.heights[int(round(self.q * (self.count - 1)))]
+        return self.heights[2]
+
+
+# The outcome of adaptively controlled replications (see runAdaptiveReplications)
+AdaptiveResult = collections.namedtuple('AdaptiveResult',
+        ['estimate', 'halfWidth', 'replications', 'completed', 'converged',
+                'stats', 'quantiles'])
+
+
+def runAdaptiveReplications(scenario, **params):
+    """
+    Run replications of <scenario> in rounds of <batch> replications until
+    the confidence interval (at level <confidence>) of the <target> is
+    narrow enough, or <max_replications> replications (or <time_budget>
+    seconds) have been used up. The target is either 'mean' or a quantile
+    q of the completion time. The interval is narrow enough once its
+    half-width is at most <precision> seconds or <relative_precision> times
+    the estimate (and at least <min_replications> handshakes completed).
+    Only streaming estimators are kept: RunningStats for the mean and
+    P2Quantile for the <quantiles>. The half-width for a quantile follows
+    from the spread of the quantile estimated separately for consecutive
+    sections of <section> completed handshakes (at least <min_sections>
+    sections are required). Replications are numbered and seeded as in
+    runReplications, so results do not depend on <batch>. Replications
+    are taken from (and added to) a ResultCache given as <cache>. Unless
+    <processes> is 1, one pool of worker processes is used for all rounds
+    (either given as <pool> or created for this call).
+    """
+
+    target = params.get('target', 'mean')
+    precision = params.get('precision', None)
+    relative_precision = params.get('relative_precision', None)
+    confidence = params.get('confidence', 0.95)
+    min_replications = params.get('min_replications', 30)
+    max_replications = params.get('max_replications', 10000)
+    time_budget = params.get('time_budget', None)
+    batch = params.get('batch', 20)
+    seed = params.get('seed', 0)
+    processes = params.get('processes', 1)
+    cache = params.get('cache', None)
+    pool = params.get('pool', None)
+    section = params.get('section', 50)
+    min_sections = params.get('min_sections', 10)
+    if precision is None and relative_precision is None:
+        raise Exception('Either precision or relative_precision is required')
+
+    stats = RunningStats()
+    quantiles = dict([(q, P2Quantile(q)) for q in params.get('quantiles', [0.5])])
+    if target != 'mean':
+        quantiles.setdefault(target, P2Quantile(target))
+        # the quantile of the current section and the statistics of the
+        # quantiles of all completed sections
+        sectionQuantile = P2Quantile(target)
+        sectionStats = RunningStats()
+
+    def getEstimate():
+        if stats.getCount() == 0:
+            return None, float('inf')
+        if target == 'mean':
+            return stats.getMean(), stats.getHalfWidth(confidence)
+        if sectionStats.getCount() < min_sections:
+            return quantiles[target].getValue(), float('inf')
+        return quantiles[target].getValue(), \
+                sectionStats.getHalfWidth(confidence)
+
+    start = time.time()
+    replications = 0
+    converged = False
+    ownPool = pool is None and processes != 1
+    if ownPool:
+        pool = multiprocessing.Pool(processes)
+    try:
+        while replications < max_replications:
+
+            count = min(batch, max_replications - replications)
+            if cache is not None:
+                results = cache.runReplications(scenario, count, seed=seed,
+                        processes=processes, first=replications, pool=pool)
             else:
-                # register a callback for reception after <duration>
-                self.scheduler.registerEventRel(Callback(receiver.receive,
-                        message=message, sender=sender), duration,
-                                Medium.priorityReceive)
+                results = runReplications(scenario, count, seed=seed,
+                        processes=processes, first=replications, pool=pool)
+            for result in results:
+                if result.completionTime is not None:
+                    stats.add(result.completionTime)
+                    for estimator in quantiles.values():
+                        estimator.add(result.completionTime)
+                    if target != 'mean':
+                        sectionQuantile.add(result.completionTime)
+                        if sectionQuantile.getCount() == section:
+                            sectionStats.add(sectionQuantile.getValue())
+                            sectionQuantile = P2Quantile(target)
+            replications += count
+
+            estimate, halfWidth = getEstimate()
+            if stats.getCount() >= min_replications:
+                limit = float('inf')
+                if precision is not None:
+                    limit = precision
+                if relative_precision is not None:
+                    limit = min(limit, relative_precision * abs(estimate))
+                if halfWidth <= limit:
+                    converged = True
+                    break
+
+            if time_budget is not None and time.time() - start >= time_budget:
+                break
+    finally:
+        if ownPool:
+            pool.close()
+            pool.join()
+
+    estimate, halfWidth = getEstimate()
+    return AdaptiveResult(estimate=estimate, halfWidth=halfWidth,
+            replications=replications, completed=stats.getCount(),
+            converged=converged, stats=stats, quantiles=quantiles)
+
+
+class ResultCache(object):
+    """
+    This class stores the results of replications on disk, one JSON file
+    per scenario and seed in <directory>. As replication #i always runs
+    with the seed deriveSeed(seed, i), the results of the first N
+    replications are valid for any request of up to N replications and
+    only missing replications are simulated.
+    """
+
+    # to be increased whenever simulation results change
+    version = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # the entries loaded or stored so far by path
+        self.entries = {}
+
+    def getHash(self, scenario, seed):
+        key = {'version': ResultCache.version, 'scenario': scenario.getKey(),
+                'seed': seed}
+        try:
+            data = json.dumps(key, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            # e.g. an object among the medium parameters
+            raise Exception('Cannot cache the results of a scenario whose '
+                    'key is not JSON serializable ({0}); run it without the '
+                    'cache'.format(e))
+        return hashlib.sha256(data).hexdigest()
+
+    def getPath(self, scenario, seed):
+        return os.path.join(self.directory,
+                self.getHash(scenario, seed) + '.json')
+
+    def load(self, scenario, seed):
+        """
+        Return the results stored for <scenario> and <seed> (a list of
+        ReplicationResult, empty if there are none)
+        """
+        path = self.getPath(scenario, seed)
+        if path not in self.entries:
+            if not os.path.exists(path):
+                return []
+            with open(path) as f:
+                entry = json.load(f)
+            self.entries[path] = [ReplicationResult(*row)
+                    for row in entry['results']]
+        return list(self.entries[path])
+
+    def store(self, scenario, seed, results):
+        entry = {
+            'version': ResultCache.version,
+            'scenario': scenario.getKey(),
+            'seed': seed,
+            'results': [list(result) for result in results],
+        }
+        # write to a temporary file first to never leave a partial entry
+        path = self.getPath(scenario, seed)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.rename(path + '.tmp', path)
+        self.entries[path] = list(results)
+
+    def runReplications(self, scenario, replications, seed=0, processes=None,
+            first=0, pool=None):
+        """
+        Like runReplications(), but take results from the cache and only
+        simulate (and store) the replications missing from it
+        """
+        results = self.load(scenario, seed)
+        if len(results) < first + replications:
+            results += runReplications(scenario,
+                    first + replications - len(results), seed=seed,
+                    processes=processes, first=len(results), pool=pool)
+            self.store(scenario, seed, results)
+        return results[first:first + replications]
+
+
+class ParameterSweep(object):
+    """
+    This class represents a grid of HandshakeScenarios for <flights>. The
+    <grid> maps Medium parameter names (or 'timeouts') to lists of values
+    and the sweep covers every combination of them (in the order of the
+    grid's keys if it is an OrderedDict, sorted by name otherwise). The
+    remaining keyword arguments are fixed parameters of every scenario.
+    """
+
+    def __init__(self, flights, grid, **params):
+        self.flights = flights
+        self.grid = grid
+        self.params = params
+
+    def getPoints(self):
+        """
+        Return the list of points of the grid, each a dictionary mapping
+        parameter names to values
+        """
+        if isinstance(self.grid, collections.OrderedDict):
+            names = self.grid.keys()
         else:
-            # >>> message got lost >>>
-            self.log(TextFormatter.makeBoldRed(('Lost message {1} sent' +
-                    ' from {0} to {1}').format(sender.getName(),
-                            receiver.getName(), str(message))))
+            names = sorted(self.grid.keys())
+        return [dict(zip(names, values)) for values in
+                itertools.product(*[self.grid[name] for name in names])]
 
+    def getScenario(self, point):
+        params = dict(self.params)
+        params.update(point)
+        timeouts = params.pop('timeouts', None)
+        return HandshakeScenario(self.flights, timeouts, **params)
+
+    def run(self, replications, seed=0, processes=None, cache=None):
+        """
+        Run <replications> replications for each point and return a list
+        of tuples (point, results). With a ResultCache given as <cache>,
+        only replications not cached yet are simulated.
+        """
+        sweep = []
+        for point in self.getPoints():
+            scenario = self.getScenario(point)
+            if cache is not None:
+                results = cache.runReplications(scenario, replications,
+                        seed=seed, processes=processes)
+            else:
+                results = runReplications(scenario, replications, seed=seed,
+                        processes=processes)
+            sweep.append((point, results))
+        return sweep
 
+    def runAdaptive(self, **params):
+        """
+        Run adaptively controlled replications for each point (keyword
+        arguments are passed on to runAdaptiveReplications) and return a
+        list of tuples (point, AdaptiveResult)
+        """
+        return [(point, runAdaptiveReplications(self.getScenario(point),
+                **params)) for point in self.getPoints()]
@@ -1,4 +1,5 @@
 import sys
+import multiprocessing
 from comsim import *
 import math
 import numpy as np
@@ -16,9 +17,9 @@ class Logger(object):
 
 
 
-def Handshake_HS1(noOfTimes,listOfTimes,Retransmit='exponential',LossRate=0.1):
+def Handshake_HS1_Flights():
 
-    flights = [
+    return [
         [
             ProtocolMessage('ClientHello', 87)
         ],
@@ -42,37 +43,61 @@ def Handshake_HS1(noOfTimes,listOfTimes,Retransmit='exponential',LossRate=0.1):
         ]
     ]
 
-    
-    while(noOfTimes):
-        noOfTimes-=1
 
-        logger = Logger()
+def Handshake_HS1_Scenario(Retransmit='exponential',LossRate=0.1,logger=None):
 
-        scheduler = Scheduler()
+    if Retransmit == 'exponential':
+        timeouts = ExponentialTimeouts(1., 10)
+    elif Retransmit == 'linear':
+        timeouts = LinearTimeouts(10., 10)
+    else:
+        # No retransmission at all
+        timeouts = None
 
-        if Retransmit == 'exponential':
-            timeouts = lambda i: 2**i if i < 10 else None
-        elif Retransmit == 'linear':
-            timeouts = lambda i: 10*(i + 1) if i < 10 else None
-        else:
-            # No retransmission at all
-            timeouts = None
+    params = {'logger': logger} if logger is not None else {}
+    return HandshakeScenario(Handshake_HS1_Flights(), timeouts, data_rate=2400./8, msg_loss_rate=LossRate, inter_msg_time=0.001, **params)
 
-        server=GenericServerAgent('server1', scheduler, flights, timeouts=timeouts, logger=logger)
-        client=GenericClientAgent('client1', scheduler, flights, timeouts=timeouts, logger=logger)
 
-        medium = Medium(scheduler, data_rate=2400./8, msg_loss_rate=LossRate, inter_msg_time=0.001, logger=logger)
-        medium.registerAgent(server)
-        medium.registerAgent(client)
-        client.trigger()
-            
-        scheduler.run()
+def Handshake_HS1(noOfTimes,listOfTimes,Retransmit='exponential',LossRate=0.1):
+
+    if noOfTimes <= 10:
+        # a few runs: run them one by one and log each event
+        scenario = Handshake_HS1_Scenario(Retransmit, LossRate, Logger())
+        results = runReplications(scenario, noOfTimes, processes=1)
+    else:
+        # run the replications in parallel (one worker process per CPU)
+        scenario = Handshake_HS1_Scenario(Retransmit, LossRate)
+        results = runReplications(scenario, noOfTimes)
+
+    for result in results:
 
-        if client.doneAtTime != 0:   #if hanshake was incomplete, don't append 0 in the list        
-            listOfTimes.append(client.doneAtTime)
+        if result.completionTime is not None:   #if hanshake was incomplete, don't append 0 in the list        
+            listOfTimes.append(result.completionTime)
         
-        print 'Total amount of data exchanged : ',client.txCount + server.txCount
-       
+        print 'Total amount of data exchanged : ',result.txBytes
+
+
+def Handshake_HS1_Adaptive(listOfTimes,Retransmit='exponential',LossRate=0.1,Precision=0.02,pool=None):
+
+    # run up to 100 replications as before, but stop early once the mean
+    # handshake time is known within +/- Precision (relative, at 95%
+    # confidence), which happens at low loss rates; returns whether it
+    # stopped early. Results are cached in .sweep-cache, so only new points
+    # are simulated (loss rates are rounded such that both plot modes share
+    # points)
+    scenario = Handshake_HS1_Scenario(Retransmit, round(LossRate, 6))
+    cache = ResultCache('.sweep-cache')
+    result = runAdaptiveReplications(scenario, relative_precision=Precision,
+            max_replications=100, batch=10, processes=None, pool=pool, cache=cache)
+
+    # the replications are cached by now: take their completion times
+    # for the exact median and variance
+    for replication in cache.runReplications(scenario, result.replications, pool=pool):
+        if replication.completionTime is not None:
+            listOfTimes.append(replication.completionTime)
+
+    return result.converged
+
 
 
 
@@ -88,6 +113,24 @@ def Handshake_HS1(noOfTimes,listOfTimes,Retransmit='exponential',LossRate=0.1):
 
 def plot_Mean_Variance_Median_Std_Against_LossRate(Comparison=0):
 
+    # one pool of worker processes for all points of the sweep
+    pool = multiprocessing.Pool()
+    try:
+        plot_Sweep(Comparison, pool)
+    finally:
+        pool.close()
+        pool.join()
+
+    plt.show()
+
+
+def plot_Sweep(Comparison, pool):
+
+    # the points that used all runs without reaching the precision
+    # (marked with 'x' in the mean plots)
+    open_rates=[]
+    open_means=[]
+
     if Comparison==0:
         Loss_Rate=0
         mean_list=[]    
@@ -101,10 +144,13 @@ def plot_Mean_Variance_Median_Std_Against_LossRate(Comparison=0):
             Loss_Rate+=0.01
             Loss_Rate_list.append(Loss_Rate)
             tmp_list=[]
-            Handshake_HS1(100,tmp_list,LossRate=Loss_Rate)
+            converged=Handshake_HS1_Adaptive(tmp_list,LossRate=Loss_Rate,pool=pool)
 
             if len(tmp_list)>0:
                 mean_list.append(np.mean(tmp_list))
+                if not converged:
+                    open_rates.append(Loss_Rate)
+                    open_means.append(np.mean(tmp_list))
                 var_list.append(np.var(tmp_list))
                 std_list.append(np.std(tmp_list))
                 median_list.append(np.median(tmp_list))
@@ -120,6 +166,7 @@ def plot_Mean_Variance_Median_Std_Against_LossRate(Comparison=0):
         plt.ylabel('Mean')
         plt.title('Loss Rate v/s Mean Handshake Time')
         plt.plot(Loss_Rate_list,mean_list)
+        plt.plot(open_rates,open_means,'kx')
 
 
         plt.figure(2)
@@ -142,9 +189,6 @@ def plot_Mean_Variance_Median_Std_Against_LossRate(Comparison=0):
         plt.title('Loss Rate v/s Median of Handshake Time')
         plt.plot(Loss_Rate_list,median_list)
 
-
-        plt.show()
-
     elif Comparison==1:
         Loss_Rate=0
         mean_list_exp=[]
@@ -164,16 +208,22 @@ def plot_Mean_Variance_Median_Std_Against_LossRate(Comparison=0):
             tmp_list_exp=[]
             tmp_list_lin=[]
 
-            Handshake_HS1(100,tmp_list_exp,Retransmit='exponential',LossRate=Loss_Rate)
-            Handshake_HS1(100,tmp_list_lin,Retransmit='linear',LossRate=Loss_Rate)
+            converged_exp=Handshake_HS1_Adaptive(tmp_list_exp,Retransmit='exponential',LossRate=Loss_Rate,pool=pool)
+            converged_lin=Handshake_HS1_Adaptive(tmp_list_lin,Retransmit='linear',LossRate=Loss_Rate,pool=pool)
             if len(tmp_list_exp)>0:
                 mean_list_exp.append(np.mean(tmp_list_exp))
+                if not converged_exp:
+                    open_rates.append(Loss_Rate)
+                    open_means.append(np.mean(tmp_list_exp))
                 var_list_exp.append(np.var(tmp_list_exp))
                 std_list_exp.append(np.std(tmp_list_exp))
                 median_list_exp.append(np.median(tmp_list_exp))
             
             if len(tmp_list_lin)>0:
                 mean_list_lin.append(np.mean(tmp_list_lin))
+                if not converged_lin:
+                    open_rates.append(Loss_Rate)
+                    open_means.append(np.mean(tmp_list_lin))
                 var_list_lin.append(np.var(tmp_list_lin))
                 std_list_lin.append(np.std(tmp_list_lin))
                 median_list_lin.append(np.median(tmp_list_lin))
@@ -197,6 +247,7 @@ def plot_Mean_Variance_Median_Std_Against_LossRate(Comparison=0):
         plt.ylabel('Mean')
         plt.title('Loss Rate v/s Mean Handshake Time')
         plt.plot(Loss_Rate_list,mean_list_exp,'r',Loss_Rate_list,mean_list_lin,'b')
+        plt.plot(open_rates,open_means,'kx')
 
 
         plt.figure(2)
@@ -220,9 +271,6 @@ def plot_Mean_Variance_Median_Std_Against_LossRate(Comparison=0):
         plt.plot(Loss_Rate_list,median_list_exp,'r',Loss_Rate_list,median_list_lin,'b')
 
 
-        plt.show()
-
-
 
 
 
@@ -584,8 +584,8 @@ def Handshake_HS1(noOfTimes,listOfTimes,Retransmit='exponential',LossRate=0.1):
         client = DTLSClient('client', scheduler,Retransmit, logger=logger)
 
         medium = Medium(scheduler, data_rate=2400./8, msg_loss_rate=LossRate, inter_msg_time=0.001, logger=logger)
-        medium.registerAgent(server)
         medium.registerAgent(client)
+        medium.registerAgent(server)
 
         client.trigger()
     
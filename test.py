@@ -48,8 +48,8 @@ def main(argv):
 
     medium = Medium(scheduler, data_rate=2400./8, msg_loss_rate=0.1, inter_msg_time=0.001, logger=logger)
 
-    server = GenericServerAgent('server1', scheduler, flights, medium=medium, logger=logger)
     client = GenericClientAgent('client1', scheduler, flights, medium=medium, logger=logger)
+    server = GenericServerAgent('server1', scheduler, flights, medium=medium, logger=logger)
 
     client.trigger()
         